@@ -0,0 +1,369 @@
+"""
+Microbenchmarks of the per item transforms in normalisation.py and of decoding each response with its schema,
+against the approaches they replaced, followed by whole crawl steps over generated data. Run with:
+
+    python -m charge_point_scrapers.benchmarks [-n 100000] [-r 100000] [-x 500000]
+
+Prints the time per call of each transform in microseconds, and for the decoders also the peak memory allocated
+while decoding a response and the memory blocks still held by the decoded result. The crawl steps are timed once
+per run over -r generated records, in milliseconds. The Excel export of a -x line feed takes minutes with the
+workbook loaded into memory, so it's timed over a single run. At the default 500000 lines the in memory export runs out
+of memory on a 6GB machine, so it runs last.
+"""
+import argparse
+import csv
+import itertools
+import json
+import re
+import sys
+import tempfile
+import timeit
+import tracemalloc
+import uuid
+from pathlib import Path
+
+import numpy as np
+from dateutil import parser
+from geopy import distance
+from openpyxl import Workbook, load_workbook
+from openpyxl.styles import Font
+from openpyxl.utils import get_column_letter
+from openpyxl.utils.exceptions import IllegalCharacterError
+from scrapy.settings import Settings
+
+from charge_point_scrapers.constants import FULL_ADDRESS_MARKER, LOCATION_URL_MARKER, ZAP_MAP_COL_MAPPING, SheetNames
+from charge_point_scrapers.gazetteer import Gazetteer, build_gazetteer
+from charge_point_scrapers.geocoding import PostcodeCache
+from charge_point_scrapers.normalisation import (
+    ADDRESS_TABLE, apply_extra_detail, format_point_details, parse_date, sanitise
+)
+from charge_point_scrapers.resume import ResumeIndex
+from charge_point_scrapers.utils import export_to_excel, filter_co_charger_radius, read_latest_feed_records
+from charge_point_scrapers.schemas import (
+    BOUNDING_BOX_DECODER, HOST_SEARCH_DECODER, LOCATION_DETAILS_DECODER, POINT_INFO_DECODER
+)
+
+# The geodesic radius filter takes ~1.5ms a host, so it's timed over at most this many generated hosts
+MAX_RADIUS_HOSTS = 500
+SAMPLE_TIMESTAMP = '2023-04-18T09:12:55.000000Z'
+SAMPLE_TEXT = 'Unit 4, Riverside Retail Park\r\nPeterborough\x0b PE1 1AA'
+# Stand in for the fields the responses carry that the scrapers don't use
+UNUSED_FIELDS = {f'unused_{idx}': {'label': f'Field {idx}', 'values': list(range(8))} for idx in range(20)}
+SAMPLE_DETAILS = json.dumps({'data': {
+    **UNUSED_FIELDS,
+    'uuid': '6f1f4a3e-9e0c-4c1e-8d55-2b7e0a6f9a10',
+    'name': 'Riverside Retail Park',
+    'country': 'GB',
+    'city': 'Peterborough',
+    'state': None,
+    'address': 'Unit 4, Riverside Retail Park',
+    'postal_code': 'PE1 1AA',
+    'parking': {'fee': 'Free for 2 hours'},
+    'devices': [{'payment_details': {'pricing': '45p/kWh'}, 'connectors': [{'type': 'CCS'}] * 4}] * 6,
+    'operator': {'name': 'Example Charging'},
+    'owner': {'telephone_number': '01733 000000'},
+    'updated_at': SAMPLE_TIMESTAMP,
+}}).encode('utf-8')
+SAMPLE_EXTRA_DETAILS = json.dumps({'resources': {'chargepoint_location_info': {'data': {'details': [
+    {'marker': {'id': FULL_ADDRESS_MARKER}, 'description': 'Unit 4\r\nPeterborough\r\nCambridgeshire\r\nPE1 1AA'},
+    {'marker': {'id': LOCATION_URL_MARKER}, 'link': {'value': 'https://example.com/riverside'}},
+]}}}}).encode('utf-8')
+SAMPLE_BOUNDING_BOX = json.dumps({
+    'data': [
+        {'uuid': f'6f1f4a3e-9e0c-4c1e-8d55-{idx:012d}', 'legacy_id': idx, 'created_at': SAMPLE_TIMESTAMP,
+         'updated_at': SAMPLE_TIMESTAMP, 'location': {'lat': 52.57, 'long': -0.24}, **UNUSED_FIELDS}
+        for idx in range(50)
+    ],
+    'meta': {'total': 120, 'last_page': 3, 'current_page': 1, 'per_page': 50},
+}).encode('utf-8')
+SAMPLE_HOST_SEARCH = json.dumps({'hosts': [
+    {'id': idx, 'status': 1, 'first_name': 'Sam', 'last_name': 'null', 'address_line_1': '1 High Street',
+     'address_line_2': None, 'city': 'Oxford', 'county': 'Oxfordshire', 'post_code': 'OX1 1AA', 'latitude': '51.75',
+     'longitude': '-1.25', 'mobile': '07000 000000', 'charging_rate': 7, 'charger_type': 'Type 2',
+     'charge_cost_rate': 2.5, **UNUSED_FIELDS}
+    for idx in range(1000)
+]}).encode('utf-8')
+DECODERS = {
+    'bounding box': (SAMPLE_BOUNDING_BOX, BOUNDING_BOX_DECODER),
+    'location details': (SAMPLE_DETAILS, LOCATION_DETAILS_DECODER),
+    'point info': (SAMPLE_EXTRA_DETAILS, POINT_INFO_DECODER),
+    'host search': (SAMPLE_HOST_SEARCH, HOST_SEARCH_DECODER),
+}
+
+
+def legacy_parse_date(date_str: str) -> str:
+    return parser.parse(date_str).strftime('%Y-%m-%d')
+
+
+def legacy_sanitise(value):
+    """The address cleanup and control character regex the Excel export used before the translate tables"""
+    value = value.replace('\r', '').replace('\n', ' ')
+    illegal_chars = re.compile(r'[\000-\010]|[\013-\014]|[\016-\037]')
+    if illegal_chars.findall(value):
+        value = re.sub(illegal_chars, ' ', value)
+    return value
+
+
+def benchmarks():
+    formatted_detail = format_point_details(SAMPLE_DETAILS, SAMPLE_TIMESTAMP, 1)
+    return {
+        'parse_date': lambda: parse_date(SAMPLE_TIMESTAMP),
+        'parse_date (dateutil)': lambda: legacy_parse_date(SAMPLE_TIMESTAMP),
+        'sanitise': lambda: sanitise(SAMPLE_TEXT, ADDRESS_TABLE),
+        'sanitise (regex)': lambda: legacy_sanitise(SAMPLE_TEXT),
+        'format_point_details': lambda: format_point_details(SAMPLE_DETAILS, SAMPLE_TIMESTAMP, 1),
+        'apply_extra_detail': lambda: apply_extra_detail(SAMPLE_EXTRA_DETAILS, formatted_detail),
+    }
+
+
+def legacy_load_scraped_ids(feed_path: Path) -> dict:
+    """How the spiders collected the scraped ids on startup before the resume index"""
+    scraped_ids = {}
+    with open(feed_path, 'r', encoding='utf-8') as f:
+        for line in f.readlines():
+            scraped_ids[json.loads(line)['uuid']] = 1
+    return scraped_ids
+
+
+def open_synced_index(index_path: Path, feed_path: Path, settings) -> ResumeIndex:
+    """What the spiders do on startup, see open_resume_index"""
+    index = ResumeIndex(index_path, 'uuid', settings)
+    index.sync_with_feed(feed_path)
+    index.conn.close()
+    return index
+
+
+def generated_postcodes(count: int) -> list:
+    """Distinct postcodes in count / 400 sectors, e.g. PE1 1AB"""
+    units = [''.join(letters) for letters in itertools.product('ABDEFGHJLNPQRSTUWXYZ', repeat=2)]
+    return [
+        f'{area}{district} {sector}{unit}'
+        for area, district, sector, unit in itertools.product(('PE', 'OX', 'SW', 'BS', 'B', 'M'), range(1, 30),
+                                                              range(10), units)
+    ][:count]
+
+
+def lookup_all(lookup, postcodes: list) -> int:
+    return sum(1 for postcode in postcodes if lookup(postcode))
+
+
+def legacy_filter_radius(hosts: list, locations: dict) -> dict:
+    """The geodesic distance from every host to every location, as filter_co_charger_radius did before NumPy"""
+    matching_hosts = {}
+    for host in hosts:
+        for latitude, longitude, radius_miles in locations.values():
+            geo_dist = distance.distance((latitude, longitude), (float(host['latitude']), float(host['longitude'])))
+            if geo_dist.miles < radius_miles:
+                matching_hosts[host['id']] = host
+    return matching_hosts
+
+
+def generated_hosts(count: int, locations: dict) -> list:
+    """
+    count hosts spread over England and Wales, plus 50 hosts per location within 0.5% of its radius either side,
+    where the haversine distance alone could put them on the wrong side
+    """
+    rng = np.random.default_rng(0)
+    coordinates = [(latitude, longitude) for latitude, longitude in zip(rng.uniform(50.5, 54.5, count),
+                                                                           rng.uniform(-4.0, 1.0, count))]
+    for latitude, longitude, radius_miles in locations.values():
+        for bearing, scale in zip(rng.uniform(0, 360, 50), rng.uniform(0.995, 1.005, 50)):
+            point = distance.distance(miles=radius_miles * scale).destination((latitude, longitude), bearing)
+            coordinates.append((point.latitude, point.longitude))
+    return [
+        {'id': idx, 'latitude': str(latitude), 'longitude': str(longitude)}
+        for idx, (latitude, longitude) in enumerate(coordinates)
+    ]
+
+
+def legacy_export_to_excel(excel_file_path: Path, jsonl_feed_path: Path, col_mapping: dict, sheet_name: str,
+                           key_field: str):
+    """
+    How export_to_excel wrote a sheet before streaming: the existing workbook and every latest feed record are loaded
+    into memory and the rows appended to a regular sheet one by one
+    """
+    workbook = load_workbook(filename=excel_file_path) if excel_file_path.exists() else Workbook()
+    if sheet_name in workbook.sheetnames:
+        workbook.remove(workbook[sheet_name])
+    sheet = workbook.create_sheet(sheet_name, 0)
+
+    column_lens = {}
+    for col_num, value in enumerate(col_mapping.values(), start=1):
+        cell = sheet.cell(row=1, column=col_num, value=value)
+        cell.font = Font(bold=True, size=12)
+        column_letter = get_column_letter(col_num)
+        column_lens[column_letter] = len(value) * 1.2
+        sheet.column_dimensions[column_letter].width = column_lens[column_letter]
+
+    records = {}
+    with open(jsonl_feed_path, 'r', encoding='utf-8') as f:
+        for line in f.readlines():
+            record = json.loads(line)
+            if record.get('deleted'):
+                records.pop(record[key_field], None)
+            else:
+                records[record[key_field]] = record
+    data = list(records.values())
+
+    for row in data:
+        row_val = []
+        for idx, key in enumerate(col_mapping, start=1):
+            val = row[key]
+            if key in ['address', 'street']:
+                val = val.replace('\r', '').replace('\n', ' ')
+            if not val:
+                val = 'N/A'
+            column_letter = get_column_letter(idx)
+            if len(val) > column_lens.get(column_letter, 0):
+                if key in ['address', 'name']:
+                    column_lens[column_letter] = len(val) * .8
+                elif key in ['charging_fee', 'parking_fee']:
+                    column_lens[column_letter] = len(val) * .53
+                else:
+                    column_lens[column_letter] = len(val)
+                sheet.column_dimensions[column_letter].width = column_lens[column_letter]
+            row_val.append(val)
+
+        try:
+            sheet.append(row_val)
+        except IllegalCharacterError:
+            sheet.append([legacy_sanitise(str(val)) for val in row_val])
+
+    workbook.save(filename=excel_file_path)
+
+
+def crawl_benchmarks(tmp_dir: Path, records: int):
+    """Steps over -r generated records, keyed by name"""
+    settings = Settings()
+    settings.setmodule('charge_point_scrapers.settings')
+
+    # A previous crawl's feed, already indexed when that crawl closed
+    feed_path = tmp_dir / 'zap_maps.jl'
+    with open(feed_path, 'w', encoding='utf-8') as f:
+        for idx in range(records):
+            f.write(json.dumps({**json.loads(SAMPLE_DETAILS)['data'], 'uuid': str(uuid.UUID(int=idx))}) + '\n')
+    index_path = tmp_dir / 'zap_maps.jl.idx'
+    index = ResumeIndex(index_path, 'uuid', settings)
+    index.sync_with_feed(feed_path)
+    index.close(feed_path)
+
+    # Co Charger host postcodes. The cache stands in for the Nominatim path once every postcode has been fetched,
+    # fetching them is rate limited to CO_CHARGER_GEOCODE_MIN_INTERVAL seconds a postcode
+    postcodes = generated_postcodes(records)
+    onspd_path = tmp_dir / 'onspd.csv'
+    with open(onspd_path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['pcds', 'oslaua', 'oscty'])
+        for idx, postcode in enumerate(postcodes):
+            writer.writerow([postcode, f'E0600{idx % 300:04d}', f'E1000{idx % 30:04d}'])
+    build_gazetteer(onspd_path, tmp_dir / 'postcodes.gaz')
+    gazetteer = Gazetteer(tmp_dir / 'postcodes.gaz')
+    cache = PostcodeCache(tmp_dir / 'postcodes.sqlite3', ttl=24 * 60 * 60)
+    with cache.conn:
+        cache.conn.executemany(
+            'INSERT INTO postcodes (postcode, city, county, fetched_at) VALUES (?, ?, ?, strftime(\'%s\'))',
+            [(postcode, 'Peterborough', 'Cambridgeshire') for postcode in postcodes]
+        )
+
+    locations = settings.getdict('CO_CHARGER_RADIUS_LOCATIONS')
+    hosts = generated_hosts(min(records, MAX_RADIUS_HOSTS), locations)
+    matching_ids = {host['id'] for host in filter_co_charger_radius(hosts, locations)}
+    if matching_ids != set(legacy_filter_radius(hosts, locations)):
+        raise AssertionError("The radius filter doesn't match the geodesic filter")
+
+    return {
+        'resume index startup': lambda: open_synced_index(index_path, feed_path, settings),
+        'resume index startup (feed)': lambda: legacy_load_scraped_ids(feed_path),
+        'postcode lookups (gazetteer)': lambda: lookup_all(gazetteer.lookup, postcodes),
+        'postcode lookups (cache)': lambda: lookup_all(cache.get, postcodes),
+        'radius filter': lambda: filter_co_charger_radius(hosts, locations),
+        'radius filter (haversine only)': lambda: filter_co_charger_radius(hosts, locations, exact_boundary=False),
+        'radius filter (geodesic)': lambda: legacy_filter_radius(hosts, locations),
+    }
+
+
+def excel_benchmarks(tmp_dir: Path, lines: int):
+    """Exports of a lines long Zap Map feed, keyed by name"""
+    feed_path = tmp_dir / 'zap_maps_export.jl'
+    record = format_point_details(SAMPLE_DETAILS, SAMPLE_TIMESTAMP, 1)
+    with open(feed_path, 'w', encoding='utf-8') as f:
+        for idx in range(lines):
+            f.write(json.dumps({**record, 'legacy_id': idx, 'uuid': str(uuid.UUID(int=idx))}) + '\n')
+
+    # Both spiders export to the same workbook, so the exports replace the Zap Map sheet a previous crawl wrote and
+    # copy the Co Charger sheet over
+    sheet_name = SheetNames.ZAP_MAP.value
+    excel_paths = {}
+    for name in ('streaming', 'legacy'):
+        excel_paths[name] = tmp_dir / f'{name}.xlsx'
+        workbook = Workbook()
+        workbook.active.title = SheetNames.CO_CHARGER.value
+        for idx in range(1000):
+            workbook.active.append([idx, 'Sam', '1 High Street', 'Oxford', 'Oxfordshire', 'OX1 1AA'])
+        workbook.save(excel_paths[name])
+        export_to_excel(
+            excel_paths[name], read_latest_feed_records(feed_path, 'uuid'), ZAP_MAP_COL_MAPPING, sheet_name, spider=None
+        )
+
+    return {
+        'excel export': lambda: export_to_excel(
+            excel_paths['streaming'], read_latest_feed_records(feed_path, 'uuid'), ZAP_MAP_COL_MAPPING, sheet_name,
+            spider=None
+        ),
+        'excel export (in memory)': lambda: legacy_export_to_excel(
+            excel_paths['legacy'], feed_path, ZAP_MAP_COL_MAPPING, sheet_name, 'uuid'
+        ),
+    }
+
+
+def memory_use(func):
+    """(peak KiB allocated while running func, memory blocks still held by its result)"""
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    result = func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    held_blocks = sys.getallocatedblocks() - blocks
+    del result
+    return peak / 1024, held_blocks
+
+
+def run(number: int, records: int, excel_lines: int):
+    for name, func in benchmarks().items():
+        seconds = min(timeit.repeat(func, number=number, repeat=3))
+        print(f'{name:<32} {seconds / number * 1e6:10.2f} us')
+
+    for name, (body, decoder) in DECODERS.items():
+        decode_number = max(1, number * 1000 // len(body))
+        for label, func in (('json.loads', lambda: json.loads(body.decode('utf-8'))),
+                            ('schema', lambda: decoder.decode(body))):
+            seconds = min(timeit.repeat(func, number=decode_number, repeat=3))
+            peak_kib, held_blocks = memory_use(func)
+            print(
+                f'{f"{name} ({label})":<32} {seconds / decode_number * 1e6:10.2f} us '
+                f'{peak_kib:10.1f} KiB peak {held_blocks:8d} blocks held'
+            )
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, func in crawl_benchmarks(Path(tmp_dir), records).items():
+            seconds = min(timeit.repeat(func, number=1, repeat=3))
+            peak_kib, _ = memory_use(func)
+            print(f'{name:<32} {seconds * 1e3:10.2f} ms {peak_kib:10.1f} KiB peak')
+
+        for name, func in excel_benchmarks(Path(tmp_dir), excel_lines).items():
+            seconds = timeit.timeit(func, number=1)
+            peak_kib, _ = memory_use(func)
+            print(f'{name:<32} {seconds * 1e3:10.2f} ms {peak_kib:10.1f} KiB peak')
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Time the per item transforms')
+    arg_parser.add_argument('-n', '--number', type=int, default=100000, help='Calls per run, defaults to 100000')
+    arg_parser.add_argument(
+        '-r', '--records', type=int, default=100000, help='Records generated for the startup steps, defaults to 100000'
+    )
+    arg_parser.add_argument(
+        '-x', '--excel-lines', type=int, default=500000, help='Feed lines exported to Excel, defaults to 500000'
+    )
+    args = arg_parser.parse_args()
+    run(args.number, args.records, args.excel_lines)
@@ -13,6 +13,23 @@ EASTERN_MOST_LONGITUDE_UK = 2
 NORTHERN_MOST_LATITUDE_UK = 60
 SOUTHERN_MOST_LATITUDE_UK = 49
 
+# Max number of records the bounding box search will page through for a single lat:long cell
+BOUNDING_BOX_RESULTS_CAP = 250
+
+# Coarse (south, west, north, east) boxes covering GB/NI land, islands included, padded by ~0.1 degrees.
+# Tiles that fall entirely outside all of these are open sea or another country and are never requested.
+GB_LAND_BOUNDING_BOXES = (
+    (49.75, -6.6, 51.4, -1.9),    # Cornwall, Devon, Somerset, Scilly Isles
+    (50.4, -3.1, 51.7, 1.6),      # South coast, Isle of Wight, Kent
+    (51.2, -5.5, 53.6, 1.9),      # Wales, Midlands, London, East Anglia
+    (53.2, -3.8, 55.95, 0.3),     # Northern England
+    (54.5, -6.7, 57.1, -1.5),     # Southern Scotland, Kintyre, Islay
+    (56.4, -7.8, 58.8, -1.6),     # Highlands, Outer Hebrides
+    (58.6, -3.6, 59.5, -2.2),     # Orkney
+    (59.4, -1.9, 61.0, -0.6),     # Shetland, Fair Isle
+    (53.9, -8.3, 55.45, -5.3),    # Northern Ireland
+)
+
 BOUNDING_BOX_FILTER_URL = 'https://api.zap-map.io/locations/v1/search/bounding-box?' \
                           'latitude={latitude}&longitude={longitude}' \
                           '&category=B_AND_B,CAMPSITE_CARAVAN_PARK,HOLIDAY_HOMES,HOSTEL,HOTEL,BEST_WESTERN,' \
@@ -72,7 +89,43 @@ ZAP_MAP_V5_POINT_INFO_HEADERS = {
     'sec-ch-ua-platform': 'Linux'
 }
 
+EARTH_RADIUS_MILES = 3958.8
+# Max relative difference between haversine and WGS-84 geodesic distances
+HAVERSINE_MAX_ERROR = 0.006
+
 XLSX_OUT_FILE = 'ChargingPoints ZapMap-CoCharger.xlsx'
+# Rows sampled to size the Excel columns before rows are streamed into a sheet
+EXCEL_WIDTH_SAMPLE_ROWS = 1000
+
+
+# Exported fields -> column names
+ZAP_MAP_COL_MAPPING = {
+    'name': 'Name',
+    'full_address': 'Full Address',
+    'street_address': 'Street Address',
+    'city': 'City',
+    'state': 'County',
+    'postal_code': 'Post Code',
+    'phone_number': 'Phone Number',
+    'operator_name': 'Charge Point Operator Name',
+    'date_created': 'Date Created',
+    'date_updated': 'Date Updated',
+    'charging_fee': 'Charging fee',
+    'parking_fee': 'Parking fee',
+    'location_url': 'Location URL'
+}
+
+CO_CHARGER_COL_MAPPING = {
+    'name': 'Name of the Host',
+    'address': 'Street Address',
+    'city': 'City',
+    'county': 'County',
+    'post_code': 'Post Code',
+    'mobile': 'Phone Number',
+    'charging_rate': 'Charging rate (kW)',
+    'charger_type': 'Connector type',
+    'charge_cost_rate': 'Rental charge (£/hour)',
+}
 
 
 class SheetNames(enum.Enum):
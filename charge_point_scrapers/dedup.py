@@ -0,0 +1,258 @@
+import hashlib
+import math
+import uuid
+from pathlib import Path
+from typing import Iterable, Optional, Union
+
+import numpy as np
+
+# Stand in for the hash of keys that hash to 0, which marks empty slots
+EMPTY_SLOT_HASH = 1
+GOLDEN_RATIO_64 = 0x9E3779B97F4A7C15
+MASK_64 = (1 << 64) - 1
+# Saved with the id sets, sets saved with other key hashes are rebuilt
+HASH_VERSION = 2
+
+
+def id_key(item_id) -> bytes:
+    """16 byte key of an id, the UUID's bytes for UUIDs and a blake2b digest for anything else"""
+    item_id = str(item_id)
+    try:
+        return uuid.UUID(item_id).bytes
+    except ValueError:
+        return hashlib.blake2b(item_id.encode('utf-8'), digest_size=16).digest()
+
+
+def _mix(value: int) -> int:
+    """splitmix64 finalizer, every input bit affects every output bit so the low bits can be used as slots"""
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK_64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK_64
+    return value ^ (value >> 31)
+
+
+def _key_hashes(key: bytes):
+    """Two independent 64 bit hashes of a key, mixed so sequential UUIDs spread out too"""
+    low, high = int.from_bytes(key[:8], 'little'), int.from_bytes(key[8:], 'little')
+    h1 = _mix(low ^ ((high * GOLDEN_RATIO_64) & MASK_64))
+    h2 = _mix(high ^ ((low * GOLDEN_RATIO_64) & MASK_64) ^ GOLDEN_RATIO_64)
+    return h1, h2
+
+
+class CompactIdSet:
+    """
+    Set of ids stored as 16 byte keys in numpy arrays with open addressing and linear probing.
+    Each slot takes 25 bytes and the table is kept 35-70% full, so 36-72 bytes per id instead of the
+    110-140 bytes of a UUID str in a set.
+    Removed ids leave a tombstone that is reused by later adds and dropped when the set grows.
+    """
+    MAX_LOAD = 0.7
+    exact = True
+
+    def __init__(self, capacity: int = 1024):
+        capacity = 1 << max(4, math.ceil(math.log2(max(capacity, 1) / self.MAX_LOAD)))
+        self.keys = np.zeros(capacity, dtype='V16')
+        # 0 for empty slots, the key's hash otherwise. Tombstones keep their hash, with deleted set
+        self.hashes = np.zeros(capacity, dtype=np.uint64)
+        self.deleted = np.zeros(capacity, dtype=bool)
+        self.count = 0
+        self.used = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    @property
+    def nbytes(self) -> int:
+        return self.keys.nbytes + self.hashes.nbytes + self.deleted.nbytes
+
+    def _find(self, key: bytes, key_hash: int):
+        """Slot of the key, or the slot it would be added to with False"""
+        mask = len(self.keys) - 1
+        slot = key_hash & mask
+        free_slot = None
+        while True:
+            slot_hash = int(self.hashes[slot])
+            if slot_hash == 0:
+                return (slot if free_slot is None else free_slot), False
+            if self.deleted[slot]:
+                if free_slot is None:
+                    free_slot = slot
+            elif slot_hash == key_hash and self.keys[slot].tobytes() == key:
+                return slot, True
+            slot = (slot + 1) & mask
+
+    def __contains__(self, item_id) -> bool:
+        key = id_key(item_id)
+        return self._find(key, _key_hashes(key)[0] or EMPTY_SLOT_HASH)[1]
+
+    def add(self, item_id) -> bool:
+        """Add the id, returns False if it was already in the set"""
+        return self._add_key(id_key(item_id))
+
+    def _add_key(self, key: bytes) -> bool:
+        key_hash = _key_hashes(key)[0] or EMPTY_SLOT_HASH
+        slot, found = self._find(key, key_hash)
+        if found:
+            return False
+        if self.hashes[slot] == 0:
+            self.used += 1
+        self.keys[slot] = key
+        self.hashes[slot] = key_hash
+        self.deleted[slot] = False
+        self.count += 1
+        if self.used > len(self.keys) * self.MAX_LOAD:
+            self._resize(len(self.keys) * 2 if self.count > len(self.keys) * self.MAX_LOAD / 2 else len(self.keys))
+        return True
+
+    def discard(self, item_id):
+        key = id_key(item_id)
+        slot, found = self._find(key, _key_hashes(key)[0] or EMPTY_SLOT_HASH)
+        if found:
+            self.deleted[slot] = True
+            self.count -= 1
+
+    def update(self, item_ids: Iterable):
+        for item_id in item_ids:
+            self.add(item_id)
+
+    def _resize(self, capacity: int):
+        live = (self.hashes != 0) & ~self.deleted
+        keys, hashes = self.keys[live], self.hashes[live]
+        self.keys = np.zeros(capacity, dtype='V16')
+        self.hashes = np.zeros(capacity, dtype=np.uint64)
+        self.deleted = np.zeros(capacity, dtype=bool)
+        mask = capacity - 1
+        for key, key_hash in zip(keys, hashes):
+            slot = int(key_hash) & mask
+            while self.hashes[slot] != 0:
+                slot = (slot + 1) & mask
+            self.keys[slot] = key
+            self.hashes[slot] = key_hash
+        self.used = self.count = len(keys)
+
+    def save(self, path: Union[Path, str]):
+        with open(path, 'wb') as f:
+            np.savez(
+                f, kind='hashset', version=HASH_VERSION, keys=self.keys, hashes=self.hashes, deleted=self.deleted
+            )
+
+    @classmethod
+    def from_arrays(cls, arrays) -> 'CompactIdSet':
+        id_set = cls.__new__(cls)
+        id_set.keys, id_set.hashes, id_set.deleted = arrays['keys'], arrays['hashes'], arrays['deleted']
+        id_set.used = int(np.count_nonzero(id_set.hashes))
+        id_set.count = id_set.used - int(np.count_nonzero(id_set.deleted))
+        return id_set
+
+
+class ScalableBloomFilter:
+    """
+    Bloom filter that adds a bigger, stricter filter each time the current one is full, so the overall false
+    positive rate stays under error_rate however many ids are added. Ids can't be removed, discard is a no-op.
+    Costs about 2-3 bytes per id at a 0.1% error rate.
+    """
+    GROWTH = 2
+    TIGHTENING = 0.5
+    exact = False
+
+    def __init__(self, error_rate: float = 0.001, capacity: int = 100000):
+        self.error_rate = error_rate
+        self.initial_capacity = capacity
+        self.filters = []
+        self.count = 0
+        self.filter_count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    @property
+    def nbytes(self) -> int:
+        return sum(bits.nbytes for bits, _, _ in self.filters)
+
+    def _add_filter(self):
+        stage = len(self.filters)
+        capacity = self.initial_capacity * self.GROWTH ** stage
+        error_rate = self.error_rate * (1 - self.TIGHTENING) * self.TIGHTENING ** stage
+        bit_count = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        hash_count = max(1, round(bit_count / capacity * math.log(2)))
+        self.filters.append((np.zeros((bit_count + 7) // 8, dtype=np.uint8), hash_count, capacity))
+        self.filter_count = 0
+
+    @staticmethod
+    def _bits(key: bytes, bit_count: int, hash_count: int):
+        h1, h2 = _key_hashes(key)
+        h2 |= 1
+        return [(h1 + i * h2) % bit_count for i in range(hash_count)]
+
+    def _in_filter(self, key: bytes, bits: np.ndarray, hash_count: int) -> bool:
+        return all(bits[bit >> 3] & (1 << (bit & 7)) for bit in self._bits(key, len(bits) * 8, hash_count))
+
+    def __contains__(self, item_id) -> bool:
+        key = id_key(item_id)
+        return any(self._in_filter(key, bits, hash_count) for bits, hash_count, _ in self.filters)
+
+    def add(self, item_id) -> bool:
+        """Add the id, returns False if it was (or looks like it was) already added"""
+        key = id_key(item_id)
+        if any(self._in_filter(key, bits, hash_count) for bits, hash_count, _ in self.filters):
+            return False
+        if not self.filters or self.filter_count >= self.filters[-1][2]:
+            self._add_filter()
+        bits, hash_count, _ = self.filters[-1]
+        for bit in self._bits(key, len(bits) * 8, hash_count):
+            bits[bit >> 3] |= 1 << (bit & 7)
+        self.filter_count += 1
+        self.count += 1
+        return True
+
+    def discard(self, item_id):
+        """Removed ids stay in the filter, sets that need removals check its hits against their source of truth"""
+
+    def update(self, item_ids: Iterable):
+        for item_id in item_ids:
+            self.add(item_id)
+
+    def save(self, path: Union[Path, str]):
+        arrays = {f'bits_{idx}': bits for idx, (bits, _, _) in enumerate(self.filters)}
+        meta = [(hash_count, capacity) for _, hash_count, capacity in self.filters]
+        with open(path, 'wb') as f:
+            np.savez(
+                f, kind='bloom', version=HASH_VERSION, meta=np.array(meta, dtype=np.int64).reshape(-1, 2),
+                counts=np.array([self.count, self.filter_count]),
+                config=np.array([self.error_rate, self.initial_capacity]), **arrays
+            )
+
+    @classmethod
+    def from_arrays(cls, arrays) -> 'ScalableBloomFilter':
+        error_rate, capacity = arrays['config']
+        bloom = cls(float(error_rate), int(capacity))
+        bloom.filters = [
+            (arrays[f'bits_{idx}'], int(hash_count), int(filter_capacity))
+            for idx, (hash_count, filter_capacity) in enumerate(arrays['meta'])
+        ]
+        bloom.count, bloom.filter_count = (int(val) for val in arrays['counts'])
+        return bloom
+
+
+def new_id_set(settings, capacity: int = 1024) -> Union[CompactIdSet, ScalableBloomFilter]:
+    """Empty id set of the DEDUP_BACKEND setting, 'hashset' or 'bloom'"""
+    if settings.get('DEDUP_BACKEND') == 'bloom':
+        return ScalableBloomFilter(settings.getfloat('DEDUP_BLOOM_ERROR_RATE'), max(capacity, 100000))
+    return CompactIdSet(capacity)
+
+
+def load_id_set(path: Union[Path, str]) -> Optional[Union[CompactIdSet, ScalableBloomFilter]]:
+    """None if the set was saved with older key hashes"""
+    with np.load(path) as arrays:
+        arrays = {name: arrays[name] for name in arrays.files}
+    if 'version' not in arrays or int(arrays['version']) != HASH_VERSION:
+        return None
+    if str(arrays['kind']) == 'bloom':
+        return ScalableBloomFilter.from_arrays(arrays)
+    return CompactIdSet.from_arrays(arrays)
+
+
+def record_id_set_stats(stats, prefix: str, id_set):
+    stats.set_value(f'{prefix}/ids', len(id_set))
+    stats.set_value(f'{prefix}/memory_bytes', id_set.nbytes)
+    if len(id_set):
+        stats.set_value(f'{prefix}/memory_mb_per_million_ids', round(id_set.nbytes / len(id_set), 1))
@@ -0,0 +1,110 @@
+import csv
+import datetime
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import List, Union
+
+# Columns written with a typed arrow schema, every other column is a string
+DATE_COLUMNS = ('date_created', 'date_updated')
+
+
+class CsvRowWriter:
+    """Writes rows to <name>.csv"""
+
+    def __init__(self, base_path: Union[Path, str], keys: List[str], columns: List[str]):
+        self.file = open(f'{base_path}.csv', 'w', encoding='utf-8', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(columns)
+
+    def write_batch(self, rows: List[list]):
+        self.writer.writerows(rows)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class ArrowRowWriter(ABC):
+    """
+    Base for typed, zstd compressed arrow files written to <name>.<extension>, each batch of rows is a row group.
+    Needs pyarrow, see requires_pyarrow
+    """
+    extension = ''
+
+    def __init__(self, base_path: Union[Path, str], keys: List[str], columns: List[str]):
+        import pyarrow
+        self.pa = pyarrow
+        self.keys = keys
+        self.schema = pyarrow.schema([
+            (column, self.column_type(key)) for key, column in zip(keys, columns)
+        ])
+        self.path = Path(f'{base_path}.{self.extension}')
+        self.writer = self.open_writer()
+
+    def column_type(self, key: str):
+        if key in DATE_COLUMNS:
+            return self.pa.date32()
+        return self.pa.string()
+
+    def convert(self, key: str, val):
+        if val in ('', None):
+            return None
+        if key in DATE_COLUMNS:
+            try:
+                return datetime.date.fromisoformat(val)
+            except ValueError:
+                return None
+        return str(val)
+
+    def record_batch(self, rows: List[list]):
+        columns = list(zip(*rows))
+        return self.pa.record_batch([
+            self.pa.array([self.convert(key, val) for val in column], type=field.type)
+            for key, field, column in zip(self.keys, self.schema, columns)
+        ], schema=self.schema)
+
+    @abstractmethod
+    def open_writer(self):
+        pass
+
+    @abstractmethod
+    def write_batch(self, rows: List[list]):
+        pass
+
+    def close(self):
+        self.writer.close()
+
+
+class ParquetRowWriter(ArrowRowWriter):
+    extension = 'parquet'
+
+    def open_writer(self):
+        import pyarrow.parquet
+        return pyarrow.parquet.ParquetWriter(self.path, self.schema, compression='zstd')
+
+    def write_batch(self, rows: List[list]):
+        self.writer.write_table(self.pa.Table.from_batches([self.record_batch(rows)]))
+
+
+class FeatherRowWriter(ArrowRowWriter):
+    extension = 'feather'
+
+    def open_writer(self):
+        return self.pa.ipc.new_file(
+            self.path, self.schema, options=self.pa.ipc.IpcWriteOptions(compression='zstd')
+        )
+
+    def write_batch(self, rows: List[list]):
+        self.writer.write_batch(self.record_batch(rows))
+
+
+ROW_WRITERS = {
+    'csv': CsvRowWriter,
+    'parquet': ParquetRowWriter,
+    'feather': FeatherRowWriter,
+}
+
+
+def requires_pyarrow(fmt: str) -> bool:
+    return issubclass(ROW_WRITERS[fmt], ArrowRowWriter)
+
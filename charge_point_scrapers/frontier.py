@@ -0,0 +1,105 @@
+import json
+import time
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Union
+
+from charge_point_scrapers.dedup import load_id_set
+from charge_point_scrapers.tiling import Tile
+
+FRONTIER_VERSION = 1
+
+
+class TilePage(NamedTuple):
+    tile: Tile
+    page: int
+    pages_requested: int
+    priority: int
+
+
+class PendingDetail(NamedTuple):
+    uuid: str
+    created_at: str
+    legacy_id: int
+    fingerprint: str
+
+
+def _raw_tile_page(tile_page: TilePage) -> list:
+    return [*tile_page.tile, tile_page.page, tile_page.pages_requested, tile_page.priority]
+
+
+def _tile_page(raw_tile_page: list) -> TilePage:
+    latitude, longitude, depth, page, pages_requested, priority = raw_tile_page
+    return TilePage(Tile(latitude, longitude, depth), page, pages_requested, priority)
+
+
+class Frontier(NamedTuple):
+    """
+    What is left of a crawl: the tile pages queued and in flight, the points whose details were requested but not
+    scraped yet and the points listed so far. Tile pages are stored as [latitude, longitude, depth, page,
+    pages_requested, priority] lists and the listed points as a compact id set in <frontier>.listed
+    """
+    tile_pages: List[TilePage]
+    in_flight_tile_pages: List[TilePage]
+    details: List[PendingDetail]
+    listed_points: object
+    listing_complete: bool
+    saved_at: int
+
+    @staticmethod
+    def listed_path(path: Path) -> Path:
+        return path.with_name(f'{path.name}.listed')
+
+    def save(self, path: Union[Path, str]):
+        """Written to temporary files and swapped in, so a crash mid save leaves the previous checkpoint"""
+        path = Path(path)
+        listed_path = self.listed_path(path)
+        tmp_listed_path = listed_path.with_name(f'{listed_path.name}.tmp')
+        self.listed_points.save(tmp_listed_path)
+        raw = {
+            'version': FRONTIER_VERSION,
+            'saved_at': self.saved_at,
+            'listing_complete': self.listing_complete,
+            'tile_pages': [_raw_tile_page(tile_page) for tile_page in self.tile_pages],
+            'in_flight_tile_pages': [_raw_tile_page(tile_page) for tile_page in self.in_flight_tile_pages],
+            'details': [list(detail) for detail in self.details],
+        }
+        tmp_path = path.with_name(f'{path.name}.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(raw, f, separators=(',', ':'))
+        # Listed points older than the tile pages are only listed again, newer ones could hide points whose tile
+        # page is still in the frontier
+        tmp_path.replace(path)
+        tmp_listed_path.replace(listed_path)
+
+    @classmethod
+    def load(cls, path: Union[Path, str]) -> Optional['Frontier']:
+        """None if there is no checkpoint or it's from an older version"""
+        path = Path(path)
+        listed_path = cls.listed_path(path)
+        if not path.exists() or not listed_path.exists():
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            raw = json.load(f)
+        if raw.get('version') != FRONTIER_VERSION:
+            return None
+        listed_points = load_id_set(listed_path)
+        if listed_points is None:
+            return None
+        return cls(
+            tile_pages=[_tile_page(raw_tile_page) for raw_tile_page in raw['tile_pages']],
+            in_flight_tile_pages=[_tile_page(raw_tile_page) for raw_tile_page in raw['in_flight_tile_pages']],
+            details=[PendingDetail(*detail) for detail in raw['details']],
+            listed_points=listed_points,
+            listing_complete=raw['listing_complete'],
+            saved_at=raw['saved_at']
+        )
+
+    @classmethod
+    def clear(cls, path: Union[Path, str]):
+        path = Path(path)
+        for frontier_path in (path, cls.listed_path(path)):
+            frontier_path.unlink(missing_ok=True)
+
+    @property
+    def age(self) -> int:
+        return int(time.time()) - self.saved_at
@@ -0,0 +1,199 @@
+"""
+Offline UK postcode gazetteer, maps postcodes to (city, county) without any network calls.
+
+Build it once from the ONS Postcode Directory (ONSPD) CSV, optionally with the ONSPD code -> name lookup CSVs
+shipped in its Documents folder, e.g. "BUASD_names and codes UK as at 12_13.csv", "BUA_names and codes UK as at
+12_13.csv", "LA_UA names and codes UK as at 04_23.csv" and "County names and codes UK as at 04_23.csv":
+
+    python -m charge_point_scrapers.gazetteer ONSPD_MAY_2023_UK.csv BUASD_names*.csv BUA_names*.csv \
+        "LA_UA names*.csv" "County names*.csv"
+
+The city is the postcode's built-up area sub-division, e.g. Salford rather than Greater Manchester, or its built-up
+area, see CITY_FIELDS. Rural postcodes and built-up areas without a name lookup fall back to the local authority
+district. The county is the postcode's county, falling back to the district for unitary authorities, Wales and
+Scotland.
+Lookups are benchmarked against the postcode cache by python -m charge_point_scrapers.benchmarks
+"""
+import argparse
+import csv
+import mmap
+import struct
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+from charge_point_scrapers.geocoding import normalise_postcode
+
+MAGIC = b'PCGZ'
+HEADER = struct.Struct('<4sIII')  # magic, version, record count, names offset
+RECORD = struct.Struct('<8sHH')  # postcode/sector/outcode key, city name id, county name id
+VERSION = 1
+# ONSPD pseudo codes, e.g. E99999999 for postcodes in unitary authorities that have no county
+PSEUDO_CODE_SUFFIX = '99999999'
+# ONSPD fields the city is taken from, most local first. The last one is the fallback for every postcode
+CITY_FIELDS = ('buasd11', 'bua11', 'oslaua')
+BUILT_UP_AREA_SUFFIXES = (' BUASD', ' BUA')
+
+
+def postcode_keys(postcode: str) -> List[str]:
+    """Lookup keys from most to least precise: full postcode, sector and outcode, e.g. PE1 1AA, PE1 1, PE1"""
+    postcode = normalise_postcode(postcode)
+    if ' ' not in postcode and len(postcode) > 4:
+        # Inward codes are always 3 characters
+        postcode = f'{postcode[:-3]} {postcode[-3:]}'
+    outcode, _, inward = postcode.partition(' ')
+    keys = [outcode]
+    if inward:
+        keys.insert(0, f'{outcode} {inward[0]}')
+        if len(inward) == 3:
+            keys.insert(0, postcode)
+    return keys
+
+
+def _encode_key(key: str) -> bytes:
+    return key.encode('ascii').ljust(8)
+
+
+class Gazetteer:
+    """Memory-mapped sorted table of postcode, sector and outcode keys, searched with a binary search"""
+
+    def __init__(self, path: Union[Path, str]):
+        self.file = open(path, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.count, names_offset = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a postcode gazetteer")
+        self.names = self.mm[names_offset:].decode('utf-8').split('\n')
+
+    def _key_at(self, index: int) -> bytes:
+        return self.mm[HEADER.size + index * RECORD.size:HEADER.size + index * RECORD.size + 8]
+
+    def _find(self, key: bytes) -> Optional[Tuple[str, str]]:
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self._key_at(lo) == key:
+            _, city_id, county_id = RECORD.unpack_from(self.mm, HEADER.size + lo * RECORD.size)
+            return self.names[city_id], self.names[county_id]
+        return None
+
+    def lookup(self, postcode: str) -> Optional[Tuple[str, str]]:
+        """(city, county) of the postcode, falling back to its sector and then its outcode"""
+        try:
+            keys = postcode_keys(postcode)
+        except UnicodeEncodeError:
+            return None
+        for key in keys:
+            if len(key) <= 8:
+                location = self._find(_encode_key(key))
+                if location:
+                    return location
+        return None
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+
+def city_name(row: dict, city_fields: Sequence[str], code_names: Dict[str, str]) -> str:
+    """
+    Name of the first of city_fields the row has a real code in with a known name, e.g. "Reading BUA" -> "Reading".
+    The last field's raw code is used if it has no name
+    """
+    *place_fields, fallback_field = city_fields
+    for field in place_fields:
+        code = row.get(field) or ''
+        if code and not code.endswith(PSEUDO_CODE_SUFFIX) and code in code_names:
+            name = code_names[code]
+            for suffix in BUILT_UP_AREA_SUFFIXES:
+                if name.endswith(suffix):
+                    name = name[:-len(suffix)]
+            return name
+    code = row[fallback_field]
+    return code_names.get(code, code)
+
+
+def load_code_names(paths: Iterable[Union[Path, str]]) -> Dict[str, str]:
+    """Read ONSPD code -> name lookups, the first column ending in CD is the code and the first ending in NM the name"""
+    names = {}
+    for path in paths:
+        with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+            reader = csv.reader(f)
+            header = [column.upper() for column in next(reader)]
+            code_idx = next(idx for idx, column in enumerate(header) if column.endswith('CD'))
+            name_idx = next(idx for idx, column in enumerate(header) if column.endswith('NM'))
+            for row in reader:
+                names[row[code_idx]] = row[name_idx]
+    return names
+
+
+def build_gazetteer(
+        onspd_path: Union[Path, str],
+        out_path: Union[Path, str],
+        code_names: Optional[Dict[str, str]] = None,
+        postcode_field: str = 'pcds',
+        city_fields: Sequence[str] = CITY_FIELDS,
+        county_field: str = 'oscty'
+) -> int:
+    """Build the gazetteer file from an ONSPD format CSV, returns the number of keys written"""
+    code_names = code_names or {}
+    names, name_ids = [], {}
+
+    def name_id(name: str) -> int:
+        if name not in name_ids:
+            name_ids[name] = len(names)
+            names.append(name)
+        return name_ids[name]
+
+    records = {}
+    prefix_counts = defaultdict(Counter)
+    with open(onspd_path, 'r', encoding='utf-8-sig', newline='') as f:
+        for row in csv.DictReader(f):
+            postcode = row[postcode_field]
+            if not postcode.strip():
+                continue
+            district_code, county_code = row[city_fields[-1]], row[county_field]
+            city = city_name(row, city_fields, code_names)
+            if county_code.endswith(PSEUDO_CODE_SUFFIX):
+                county = code_names.get(district_code, district_code)
+            else:
+                county = code_names.get(county_code, county_code)
+            location = (name_id(city), name_id(county))
+
+            keys = postcode_keys(postcode)
+            records[keys[0]] = location
+            for prefix in keys[1:]:
+                prefix_counts[prefix][location] += 1
+
+    for prefix, counts in prefix_counts.items():
+        records.setdefault(prefix, counts.most_common(1)[0][0])
+
+    sorted_keys = sorted(_encode_key(key) for key in records if len(key) <= 8)
+    names_offset = HEADER.size + len(sorted_keys) * RECORD.size
+    with open(out_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(sorted_keys), names_offset))
+        for key in sorted_keys:
+            f.write(RECORD.pack(key, *records[key.decode('ascii').rstrip()]))
+        f.write('\n'.join(names).encode('utf-8'))
+    return len(sorted_keys)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the offline postcode gazetteer from the ONS Postcode Directory')
+    parser.add_argument('onspd_csv', help='ONSPD CSV, e.g. Data/ONSPD_MAY_2023_UK.csv')
+    parser.add_argument('names_csv', nargs='*', help='ONSPD code -> name lookup CSVs from its Documents folder')
+    parser.add_argument('-o', '--output', default='postcodes.gaz', help='Output file, defaults to postcodes.gaz')
+    parser.add_argument(
+        '--city-fields', default=','.join(CITY_FIELDS),
+        help=f"ONSPD fields to take the city from, most local first, defaults to {','.join(CITY_FIELDS)}"
+    )
+    args = parser.parse_args()
+
+    written = build_gazetteer(
+        args.onspd_csv, args.output, load_code_names(args.names_csv), city_fields=args.city_fields.split(',')
+    )
+    print(f"Wrote {written} postcodes, sectors and outcodes to {args.output}")
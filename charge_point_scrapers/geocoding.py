@@ -0,0 +1,141 @@
+import re
+import sqlite3
+import time
+from pathlib import Path
+from typing import Optional, Tuple, Union
+
+import requests
+from geopy import Nominatim
+from twisted.internet import defer, reactor, task, threads
+from twisted.python.failure import Failure
+
+POSTCODE_WHITESPACE = re.compile(r'\s+')
+
+
+def normalise_postcode(postcode: str) -> str:
+    return POSTCODE_WHITESPACE.sub(' ', postcode.strip().upper())
+
+
+class PostcodeCache:
+    """Persistent postcode -> (city, county) cache. Entries older than ttl seconds are looked up again"""
+
+    def __init__(self, path: Union[Path, str], ttl: int):
+        self.ttl = ttl
+        self.conn = sqlite3.connect(str(path))
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS postcodes '
+            '(postcode TEXT PRIMARY KEY, city TEXT, county TEXT, fetched_at INTEGER) WITHOUT ROWID'
+        )
+
+    def get(self, postcode: str) -> Optional[Tuple[str, str]]:
+        row = self.conn.execute(
+            'SELECT city, county FROM postcodes WHERE postcode = ? AND fetched_at >= ?',
+            (postcode, int(time.time()) - self.ttl)
+        ).fetchone()
+        return tuple(row) if row else None
+
+    def set(self, postcode: str, city: str, county: str):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO postcodes (postcode, city, county, fetched_at) VALUES (?, ?, ?, ?)',
+            (postcode, city, county, int(time.time()))
+        )
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+class PostcodeEnricher:
+    """
+    Looks up the city and county of UK postcodes, from the offline gazetteer when one is given and otherwise
+    off the reactor thread through Nominatim and wikishire.
+    Network lookups are cached, concurrent lookups of the same postcode share one request, at most `concurrency`
+    lookups run at a time and they are started at least `min_interval` seconds apart to respect Nominatim's
+    usage policy.
+    """
+
+    def __init__(
+            self,
+            cache: PostcodeCache,
+            stats,
+            logger,
+            concurrency: int = 1,
+            min_interval: float = 1.0,
+            gazetteer=None
+    ):
+        self.cache = cache
+        self.gazetteer = gazetteer
+        self.stats = stats
+        self.logger = logger
+        self.semaphore = defer.DeferredSemaphore(concurrency)
+        self.min_interval = min_interval
+        self.next_slot = 0.0
+        self.in_flight = {}
+        self.geolocator = Nominatim(user_agent='some random ua')
+
+    def lookup(self, postcode: str) -> defer.Deferred:
+        """Deferred firing with (city, county), or None if the lookup failed"""
+        postcode = normalise_postcode(postcode)
+        if self.gazetteer:
+            location = self.gazetteer.lookup(postcode)
+            if location:
+                self.stats.inc_value('geocoding/gazetteer_hit')
+                return defer.succeed(location)
+
+        cached = self.cache.get(postcode)
+        if cached:
+            self.stats.inc_value('geocoding/cache_hit')
+            return defer.succeed(cached)
+
+        if postcode not in self.in_flight:
+            self.stats.inc_value('geocoding/cache_miss')
+            self.in_flight[postcode] = []
+            d = self.semaphore.run(self._rate_limited_fetch, postcode)
+            d.addBoth(self._resolve, postcode)
+        else:
+            self.stats.inc_value('geocoding/deduplicated')
+
+        waiter = defer.Deferred()
+        self.in_flight[postcode].append(waiter)
+        return waiter
+
+    def _rate_limited_fetch(self, postcode: str) -> defer.Deferred:
+        now = time.monotonic()
+        delay = max(0.0, self.next_slot - now)
+        self.next_slot = now + delay + self.min_interval
+        return task.deferLater(reactor, delay, threads.deferToThread, self._fetch, postcode)
+
+    def _fetch(self, postcode: str) -> Tuple[str, str]:
+        """Runs in a thread pool thread"""
+        city = ''
+        loc = self.geolocator.geocode(postcode, addressdetails=True)
+        if loc:
+            addr = loc.raw['address']
+            city = addr.get('city') or \
+                addr.get('town') or \
+                addr.get('village') or \
+                addr.get('city_district') or \
+                addr.get('suburb') or \
+                addr.get('county') or ''
+
+        res = requests.get(f"https://wikishire.co.uk/lookup/postcode?pc={postcode}")
+        county = res.text.strip() if res.ok else ''
+        return city, county
+
+    def _resolve(self, result, postcode: str):
+        waiters = self.in_flight.pop(postcode)
+        if isinstance(result, Failure):
+            self.stats.inc_value('geocoding/failed')
+            self.logger.warning(f"Failed to look up postcode {postcode}: {result.getErrorMessage()}")
+            result = None
+        else:
+            self.stats.inc_value('geocoding/fetched')
+            self.cache.set(postcode, *result)
+
+        for waiter in waiters:
+            waiter.callback(result)
+
+    def close(self):
+        self.cache.close()
+        if self.gazetteer:
+            self.gazetteer.close()
@@ -7,11 +7,49 @@ import scrapy
 
 
 class ZapMapRawPoint(scrapy.Item):
-    token = scrapy.Field(serializer=str)
+    """A point listed by the bounding box search, see schemas.BoundingBoxPoint"""
     legacy_id = scrapy.Field(serializer=int)
     uuid = scrapy.Field(serializer=str)
     created_at = scrapy.Field(serializer=str)
+    updated_at = scrapy.Field(serializer=str)
 
 
 class ZapMapFinalPoint(scrapy.Item):
-    pass
+    """A scraped point as built by normalisation.format_point_details, or a tombstone with deleted set"""
+    legacy_id = scrapy.Field(serializer=int)
+    uuid = scrapy.Field(serializer=str)
+    name = scrapy.Field(serializer=str)
+    city = scrapy.Field(serializer=str)
+    state = scrapy.Field(serializer=str)
+    street_address = scrapy.Field(serializer=str)
+    postal_code = scrapy.Field(serializer=str)
+    full_address = scrapy.Field(serializer=str)
+    phone_number = scrapy.Field(serializer=str)
+    date_created = scrapy.Field(serializer=str)
+    date_updated = scrapy.Field(serializer=str)
+    parking_fee = scrapy.Field()
+    charging_fee = scrapy.Field()
+    operator_name = scrapy.Field(serializer=str)
+    location_url = scrapy.Field(serializer=str)
+    deleted = scrapy.Field(serializer=bool)
+
+
+class CoChargerHost(scrapy.Item):
+    """A host from the host search. name and address are filled in by CoChargerRawPipeline"""
+    id = scrapy.Field()
+    status = scrapy.Field()
+    first_name = scrapy.Field(serializer=str)
+    last_name = scrapy.Field(serializer=str)
+    address_line_1 = scrapy.Field(serializer=str)
+    address_line_2 = scrapy.Field(serializer=str)
+    city = scrapy.Field(serializer=str)
+    county = scrapy.Field(serializer=str)
+    post_code = scrapy.Field(serializer=str)
+    latitude = scrapy.Field()
+    longitude = scrapy.Field()
+    mobile = scrapy.Field()
+    charging_rate = scrapy.Field()
+    charger_type = scrapy.Field()
+    charge_cost_rate = scrapy.Field()
+    name = scrapy.Field(serializer=str)
+    address = scrapy.Field(serializer=str)
@@ -3,11 +3,36 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import json
+import logging
+import time
+from collections import deque
+from pathlib import Path
+from typing import Optional
+
 from scrapy import signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.httpobj import urlparse_cached
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.task import deferLater
+from twisted.python.failure import Failure
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
 
+from charge_point_scrapers.constants import (
+    BOUNDING_BOX_FILTER_URL, CHARGE_POINT_DETAILS_ENDPOINT, CHARGE_POINT_EXTRA_DETAILS_ENDPOINT
+)
+from charge_point_scrapers.proxy_pool import ProxyPool, ProxyState
+from charge_point_scrapers.rate_control import AimdLimit, parse_retry_after
+from charge_point_scrapers.response_cache import CachedResponse, ResponseCache
+from charge_point_scrapers.utils import decode_jwt_expiry, request_zap_auth_token
+
+logger = logging.getLogger(__name__)
+
 
 class EvChargePointsSpiderMiddleware:
     # Not all methods need to be defined. If a method is not defined,
@@ -101,3 +126,425 @@ class EvChargePointsDownloaderMiddleware:
 
     def spider_opened(self, spider):
         spider.logger.info("Spider opened: %s" % spider.name)
+
+
+class DetailResponseCacheMiddleware:
+    """
+    Caches Zap Map location detail and info responses so re-crawls don't download them again.
+    Entries younger than the endpoint's ZAP_MAP_DETAIL_CACHE_TTL_DAYS are served from the cache unless the
+    request's cache_version meta, the point's listing fingerprint, changed since they were stored. Older entries
+    are revalidated with If-None-Match / If-Modified-Since when the API sent an ETag or Last-Modified header.
+    Every other request, e.g. the auth token and bounding box searches, bypasses the cache.
+    """
+    endpoint_prefixes = {
+        'details': CHARGE_POINT_DETAILS_ENDPOINT.split('{')[0],
+        'extra_details': CHARGE_POINT_EXTRA_DETAILS_ENDPOINT.split('{')[0],
+    }
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('ZAP_MAP_DETAIL_CACHE_ENABLED'):
+            raise NotConfigured
+        self.stats = crawler.stats
+        self.ttls = {
+            endpoint: days * 24 * 60 * 60
+            for endpoint, days in settings.getdict('ZAP_MAP_DETAIL_CACHE_TTL_DAYS').items()
+        }
+        self.cache = ResponseCache(
+            Path(__file__).parent.parent / settings.get('ZAP_MAP_DETAIL_CACHE_FILE'),
+            max_bytes=settings.getint('ZAP_MAP_DETAIL_CACHE_MAX_MB') * 1024 * 1024
+        )
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def endpoint(self, request) -> Optional[str]:
+        if request.method != 'GET' or request.meta.get('dont_cache'):
+            return None
+        for endpoint, prefix in self.endpoint_prefixes.items():
+            if request.url.startswith(prefix):
+                return endpoint
+        return None
+
+    def process_request(self, request, spider):
+        endpoint = self.endpoint(request)
+        if not endpoint:
+            return None
+
+        entry = self.cache.get(request.url)
+        if not entry:
+            self.stats.inc_value(f'response_cache/{endpoint}/miss')
+            return None
+
+        version = request.meta.get('cache_version')
+        is_current = version is None or entry.version == version
+        if is_current and time.time() - entry.stored_at < self.ttls.get(endpoint, 0):
+            self.stats.inc_value(f'response_cache/{endpoint}/hit')
+            self.stats.inc_value('response_cache/bytes_saved', len(entry.body))
+            return self.cached_response(request, entry)
+
+        if entry.etag or entry.last_modified:
+            self.stats.inc_value(f'response_cache/{endpoint}/revalidate')
+            if entry.etag:
+                request.headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                request.headers['If-Modified-Since'] = entry.last_modified
+        else:
+            self.stats.inc_value(f'response_cache/{endpoint}/stale')
+        return None
+
+    def process_response(self, request, response, spider):
+        endpoint = self.endpoint(request)
+        if not endpoint or 'cached' in response.flags:
+            return response
+
+        version = request.meta.get('cache_version')
+        if response.status == 304:
+            entry = self.cache.get(request.url)
+            if entry:
+                self.stats.inc_value(f'response_cache/{endpoint}/revalidated')
+                self.stats.inc_value('response_cache/bytes_saved', len(entry.body))
+                self.cache.refresh(request.url, version)
+                return self.cached_response(request, entry)
+        elif response.status == 200:
+            headers = {
+                key.decode('latin1'): [val.decode('latin1') for val in vals]
+                for key, vals in response.headers.items()
+            }
+            evicted = self.cache.set(request.url, response.status, headers, response.body, version)
+            self.stats.inc_value(f'response_cache/{endpoint}/stored')
+            if evicted:
+                self.stats.inc_value('response_cache/evicted', evicted)
+        return response
+
+    def cached_response(self, request, entry: CachedResponse):
+        headers = Headers(entry.headers)
+        respcls = responsetypes.from_args(headers=headers, url=request.url, body=entry.body)
+        return respcls(
+            url=request.url, status=entry.status, headers=headers, body=entry.body, flags=['cached'], request=request
+        )
+
+    def spider_closed(self, spider):
+        self.stats.set_value('response_cache/size_mb', round(self.cache.total_bytes / 1024 / 1024, 1))
+        self.cache.close()
+
+
+class ZapMapAuthMiddleware:
+    """
+    Owns the Zap Map guest token and adds it to requests with zap_auth meta.
+    The token's expiry is read from the JWT. Once it's within ZAP_MAP_TOKEN_REFRESH_MARGIN seconds of expiring
+    a new one is fetched in the background while requests keep using the current one, so requests only wait for
+    a token on startup or if the current one expired or was rejected. Requests that get a 401 are sent again with
+    the latest token, up to ZAP_MAP_AUTH_MAX_REPLAYS times.
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.refresh_margin = settings.getint('ZAP_MAP_TOKEN_REFRESH_MARGIN')
+        self.default_ttl = settings.getint('ZAP_MAP_TOKEN_DEFAULT_TTL')
+        self.max_replays = settings.getint('ZAP_MAP_AUTH_MAX_REPLAYS')
+        self.token = None
+        self.expires_at = 0.0
+        # Deferreds waiting for the token refresh in progress, None when no refresh is in progress
+        self.waiters = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def process_request(self, request, spider):
+        if not request.meta.get('zap_auth'):
+            return None
+
+        remaining = self.expires_at - time.time()
+        if self.token and remaining > 0:
+            if remaining < self.refresh_margin and self.waiters is None:
+                self.refresh_token().addErrback(lambda failure: None)
+            self.authorize(request)
+            return None
+
+        self.stats.inc_value('zap_maps/auth/requests_held')
+        d = self.refresh_token()
+        d.addCallback(lambda _: self.authorize(request))
+        return d
+
+    def authorize(self, request):
+        request.headers['Authorization'] = f"Bearer {self.token}"
+        request.meta['zap_auth_token'] = self.token
+
+    def refresh_token(self) -> Deferred:
+        """Deferred firing once a new token is set, all callers share the one token request"""
+        waiter = Deferred()
+        if self.waiters is None:
+            self.waiters = []
+            self.stats.inc_value('zap_maps/auth/refreshes')
+            d = self.crawler.engine.download(request_zap_auth_token(callback=None))
+            d.addCallback(self.token_received)
+            d.addBoth(self.release_waiters)
+        self.waiters.append(waiter)
+        return waiter
+
+    def token_received(self, response):
+        if response.status != 200:
+            raise IgnoreRequest(f"Zap Map token request failed with status {response.status}")
+        self.token = json.loads(response.text)['access_token'].strip()
+        expires_at = decode_jwt_expiry(self.token)
+        if expires_at is None:
+            logger.warning(f"Couldn't read the Zap Map token expiry, assuming it expires in {self.default_ttl}s")
+            expires_at = time.time() + self.default_ttl
+        self.expires_at = expires_at
+        logger.info(f"Got a new Zap Map token, expires in {int(expires_at - time.time())}s")
+
+    def release_waiters(self, result):
+        waiters, self.waiters = self.waiters, None
+        for waiter in waiters:
+            if isinstance(result, Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(None)
+
+    def process_response(self, request, response, spider):
+        if response.status != 401 or not request.meta.get('zap_auth'):
+            return response
+
+        self.stats.inc_value('zap_maps/auth/unauthorized')
+        if request.meta.get('zap_auth_token') == self.token:
+            # Rejected before its expiry, the next request waits for a new one
+            self.expires_at = 0.0
+
+        replays = request.meta.get('zap_auth_replays', 0)
+        if replays >= self.max_replays:
+            spider.logger.error(f"Gave up on {request.url} after {replays} replays with a new token")
+            return response
+        self.stats.inc_value('zap_maps/auth/replayed')
+        replay = request.replace(dont_filter=True)
+        replay.meta['zap_auth_replays'] = replays + 1
+        return replay
+
+
+class ProxyPoolMiddleware:
+    """
+    Sends requests through the proxies in PROXY_POOL_FILE, see ProxyPool.
+    Bans (PROXY_POOL_BAN_CODES) and connection errors quarantine the proxy and send the request again through
+    another one, up to PROXY_POOL_MAX_SWITCHES times, without using up its retries. When every proxy is busy or
+    quarantined, requests wait for one to free up.
+    Runs after HttpProxyMiddleware, so the proxies can't need credentials. Requests with a proxy or dont_proxy
+    meta of their own are left alone. Bans still count against AdaptiveRateMiddleware's limits, which sees every
+    download through the response_downloaded signal, while connection errors are put down to the proxy.
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('PROXY_POOL_ENABLED'):
+            raise NotConfigured
+        self.stats = crawler.stats
+        self.pool = ProxyPool.from_file(
+            Path(__file__).parent.parent / settings.get('PROXY_POOL_FILE'),
+            max_concurrency=settings.getint('PROXY_POOL_MAX_CONCURRENCY_PER_PROXY'),
+            base_backoff=settings.getfloat('PROXY_POOL_BASE_BACKOFF'),
+            max_backoff=settings.getfloat('PROXY_POOL_MAX_BACKOFF')
+        )
+        if not len(self.pool):
+            raise NotConfigured(f"No proxies in {settings.get('PROXY_POOL_FILE')}")
+        self.ban_codes = {int(code) for code in settings.getlist('PROXY_POOL_BAN_CODES')}
+        self.max_switches = settings.getint('PROXY_POOL_MAX_SWITCHES')
+        # (Deferred, request) of requests waiting for a proxy
+        self.waiters = deque()
+        self.wake_call = None
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def process_request(self, request, spider):
+        if request.meta.get('dont_proxy') or ('proxy' in request.meta and 'proxy_pool_proxy' not in request.meta):
+            return None
+
+        proxy = self.pool.acquire()
+        if proxy:
+            self.assign(request, proxy)
+            return None
+
+        self.stats.inc_value('proxy_pool/requests_held')
+        waiter = Deferred()
+        self.waiters.append((waiter, request))
+        self.schedule_wake()
+        return waiter
+
+    def assign(self, request, proxy: ProxyState):
+        request.meta['proxy'] = proxy.url
+        request.meta['proxy_pool_proxy'] = proxy.url
+        self.stats.inc_value('proxy_pool/assigned')
+
+    def wake(self):
+        """Hand the free proxies to the waiting requests"""
+        self.wake_call = None
+        while self.waiters:
+            proxy = self.pool.acquire()
+            if not proxy:
+                break
+            waiter, request = self.waiters.popleft()
+            self.assign(request, proxy)
+            waiter.callback(None)
+        self.schedule_wake()
+
+    def schedule_wake(self):
+        """Wake the waiting requests when the next proxy leaves quarantine, busy proxies wake them on release"""
+        if not self.waiters or self.wake_call is not None:
+            return
+        available_at = self.pool.next_available_at()
+        if available_at is not None:
+            self.wake_call = reactor.callLater(max(0.0, available_at - time.time()), self.wake)
+
+    def release(self, request, success: Optional[bool] = None):
+        proxy_url = request.meta['proxy_pool_proxy']
+        # Set by the download handler once the response headers are in, leaving out the time spent queued
+        latency = request.meta.get('download_latency')
+        if self.pool.release(proxy_url, success, latency):
+            self.stats.inc_value('proxy_pool/quarantined')
+        if self.waiters:
+            self.wake()
+
+    def switch_proxy(self, request, reason: str):
+        """The request again through another proxy, or None once it has been switched too often"""
+        switches = request.meta.get('proxy_pool_switches', 0)
+        if switches >= self.max_switches:
+            self.stats.inc_value('proxy_pool/gave_up')
+            return None
+        self.stats.inc_value(f'proxy_pool/switched/{reason}')
+        switched = request.replace(dont_filter=True)
+        for key in ('proxy', 'proxy_pool_proxy', 'download_latency'):
+            switched.meta.pop(key, None)
+        switched.meta['proxy_pool_switches'] = switches + 1
+        return switched
+
+    def is_pool_request(self, request) -> bool:
+        proxy_url = request.meta.get('proxy_pool_proxy')
+        return bool(proxy_url) and request.meta.get('proxy') == proxy_url
+
+    def process_response(self, request, response, spider):
+        if not self.is_pool_request(request):
+            return response
+        if 'cached' in response.flags:
+            self.release(request)
+            return response
+
+        if response.status in self.ban_codes:
+            self.stats.inc_value('proxy_pool/banned')
+            self.release(request, success=False)
+            return self.switch_proxy(request, 'banned') or response
+
+        self.release(request, success=response.status < 500)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        if not self.is_pool_request(request):
+            return None
+        self.stats.inc_value('proxy_pool/failed')
+        self.release(request, success=False)
+        return self.switch_proxy(request, 'failed')
+
+    def spider_closed(self, spider):
+        if self.wake_call is not None and self.wake_call.active():
+            self.wake_call.cancel()
+        self.stats.set_value('proxy_pool/available', self.pool.available_count())
+        healthiest = sorted(self.pool.proxies.values(), key=lambda proxy: proxy.weight, reverse=True)[:5]
+        spider.logger.info("Healthiest proxies: " + ', '.join(
+            f"{proxy.url} ({proxy.success_rate:.0%}, {proxy.latency:.2f}s)" for proxy in healthiest
+        ))
+
+
+class AdaptiveRateMiddleware:
+    """
+    Gives each host and endpoint class, e.g. api.zap-map.io bounding box searches, its own download slot with
+    its own AIMD concurrency limit, see AimdLimit. Throttling responses (ADAPTIVE_RATE_THROTTLE_CODES),
+    5xx errors and download errors cut the limit and a Retry-After header pauses the slot for as long as asked.
+    Current limits and latencies are kept in the adaptive_rate/ stats.
+    Responses are measured on the response_downloaded signal rather than in process_response, so throttling
+    responses that ProxyPoolMiddleware sends again through another proxy still cut the limit. Cached responses
+    never reach the downloader.
+    """
+    endpoint_prefixes = {
+        'bounding_box': BOUNDING_BOX_FILTER_URL.split('?')[0],
+        'location_detail': CHARGE_POINT_DETAILS_ENDPOINT.split('{')[0],
+        'v5_info': CHARGE_POINT_EXTRA_DETAILS_ENDPOINT.split('{')[0],
+    }
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('ADAPTIVE_RATE_ENABLED'):
+            raise NotConfigured
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.limit_kwargs = {
+            'start': settings.getfloat('ADAPTIVE_RATE_START_CONCURRENCY'),
+            'minimum': settings.getfloat('ADAPTIVE_RATE_MIN_CONCURRENCY'),
+            'maximum': settings.getfloat('ADAPTIVE_RATE_MAX_CONCURRENCY'),
+            'decrease_factor': settings.getfloat('ADAPTIVE_RATE_DECREASE_FACTOR'),
+            'latency_tolerance': settings.getfloat('ADAPTIVE_RATE_LATENCY_TOLERANCE'),
+        }
+        self.throttle_codes = {int(code) for code in settings.getlist('ADAPTIVE_RATE_THROTTLE_CODES')}
+        self.max_retry_after = settings.getfloat('ADAPTIVE_RATE_MAX_RETRY_AFTER')
+        self.limits = {}
+        crawler.signals.connect(self.response_downloaded, signal=signals.response_downloaded)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def slot_key(self, request) -> str:
+        for endpoint, prefix in self.endpoint_prefixes.items():
+            if request.url.startswith(prefix):
+                return f'{urlparse_cached(request).hostname}/{endpoint}'
+        return urlparse_cached(request).hostname or ''
+
+    def apply_limit(self, key: str):
+        slot = self.crawler.engine.downloader.slots.get(key)
+        limit = self.limits[key]
+        if slot:
+            slot.concurrency = limit.concurrency
+        self.stats.set_value(f'adaptive_rate/{key}/concurrency', round(limit.limit, 2))
+
+    def process_request(self, request, spider):
+        key = request.meta.setdefault('download_slot', self.slot_key(request))
+        if key not in self.limits:
+            self.limits[key] = AimdLimit(**self.limit_kwargs)
+        self.apply_limit(key)
+
+        wait = self.limits[key].paused_until - time.time()
+        if wait > 0:
+            self.stats.inc_value(f'adaptive_rate/{key}/paused_requests')
+            return deferLater(reactor, wait, lambda: None)
+        return None
+
+    def response_downloaded(self, response, request, spider):
+        key = request.meta.get('download_slot')
+        if key not in self.limits:
+            return
+
+        limit = self.limits[key]
+        if response.status in self.throttle_codes or response.status >= 500:
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            if retry_after is not None:
+                retry_after = min(retry_after, self.max_retry_after)
+                self.stats.inc_value(f'adaptive_rate/{key}/retry_after')
+                spider.logger.info(f"{key} asked to retry after {retry_after:.0f}s, pausing it")
+            if limit.on_congestion(retry_after):
+                self.stats.inc_value(f'adaptive_rate/{key}/decreased')
+        else:
+            limit.on_success(request.meta.get('download_latency', 0.0))
+            self.stats.set_value(f'adaptive_rate/{key}/latency_ms', round(limit.latency * 1000))
+        self.apply_limit(key)
+
+    def process_exception(self, request, exception, spider):
+        key = request.meta.get('download_slot')
+        if key in self.limits:
+            if self.limits[key].on_congestion():
+                self.stats.inc_value(f'adaptive_rate/{key}/decreased')
+            self.apply_limit(key)
+        return None
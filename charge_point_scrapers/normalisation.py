@@ -0,0 +1,104 @@
+"""
+Per item transforms: turning raw Zap Map responses into items and cleaning up their values. Everything here works
+on response bodies and plain values so it can run in the spider or in the worker processes of a
+BatchedProcessPool, see NORMALISATION_PROCESSES. Benchmarked by python -m charge_point_scrapers.benchmarks
+"""
+import datetime
+import re
+from typing import Optional
+
+from dateutil import parser
+
+from charge_point_scrapers.constants import FULL_ADDRESS_MARKER, LOCATION_URL_MARKER
+from charge_point_scrapers.schemas import LOCATION_DETAILS_DECODER, POINT_INFO_DECODER, PointInfoResponse
+
+ISO_DATE_RE = re.compile(r'\d{4}-\d{2}-\d{2}(?:[T ]|$)')
+# The control characters openpyxl refuses to write, see openpyxl.cell.cell.ILLEGAL_CHARACTERS_RE
+CONTROL_CHARACTERS = [*range(0o0, 0o11), *range(0o13, 0o15), *range(0o16, 0o40)]
+CONTROL_CHARACTERS_TABLE = str.maketrans({chr(code): ' ' for code in CONTROL_CHARACTERS})
+# Addresses are written on one line
+ADDRESS_TABLE = str.maketrans({**CONTROL_CHARACTERS_TABLE, '\r': None, '\n': ' '})
+
+
+def parse_date(date_str: str) -> str:
+    """
+    YYYY-MM-DD of a date. The API sends ISO 8601 timestamps, whose date is read straight from the first 10
+    characters, same as dateutil would without converting time zones. Anything else goes through dateutil
+    """
+    if ISO_DATE_RE.match(date_str):
+        try:
+            return datetime.date.fromisoformat(date_str[:10]).isoformat()
+        except ValueError:
+            pass
+    return parser.parse(date_str).strftime('%Y-%m-%d')
+
+
+def sanitise(value, table: dict = CONTROL_CHARACTERS_TABLE):
+    """Strings with the control characters Excel can't hold replaced by spaces, in one pass. Others as they are"""
+    return value.translate(table) if isinstance(value, str) else value
+
+
+def format_point_details(body: bytes, date_created: str, legacy_id: int) -> Optional[dict]:
+    """The point in a location details response formatted as an item, None for points outside GB"""
+    details = LOCATION_DETAILS_DECODER.decode(body).data
+    if (details.country or '').upper() != 'GB':
+        return None
+    city = details.city or ''
+    state = details.state or ''
+    street_address = details.address or ''
+    postal_code = details.postal_code or ''
+    address = " ".join([field for field in [street_address, city, state, postal_code] if field])
+    parking_fee = (details.parking and details.parking.fee) or ''
+    charging_fee = ''
+    devices = details.devices or []
+    if len(devices) > 0 and devices[0].payment_details:
+        charging_fee = devices[0].payment_details.pricing
+    operator_name = (details.operator and details.operator.name) or ''
+    phone_number = (details.owner and details.owner.telephone_number) or ''
+
+    return {
+        'legacy_id': legacy_id,
+        'uuid': details.uuid,
+        'name': details.name or '',
+        'city': city,
+        'state': state,
+        'street_address': street_address,
+        'postal_code': postal_code,
+        'full_address': address,
+        'phone_number': phone_number,
+        'date_created': parse_date(date_created) if date_created else '',
+        'date_updated': parse_date(details.updated_at) if details.updated_at else '',
+        'parking_fee': parking_fee,
+        'charging_fee': charging_fee,
+        'operator_name': operator_name,
+        'location_url': f"https://www.zap-map.com/charge-points/{details.uuid}/"
+    }
+
+
+def apply_extra_detail(body: bytes, formatted_detail: dict) -> dict:
+    """Copy of the point with the county and location URL from its v5 info response"""
+    formatted_detail = dict(formatted_detail)
+    parsed_response = POINT_INFO_DECODER.decode(body)
+    if not isinstance(parsed_response, PointInfoResponse) or not parsed_response.resources:
+        return formatted_detail
+
+    full_detail_address = None
+    location_info = parsed_response.resources.chargepoint_location_info
+    extra_details = (location_info and location_info.data and location_info.data.details) or []
+    for detail in extra_details:
+        marker_id = (detail.marker and detail.marker.id) or 0
+        if marker_id == FULL_ADDRESS_MARKER:
+            full_detail_address = (detail.description or '').strip()
+        elif marker_id == LOCATION_URL_MARKER:
+            formatted_detail['location_url'] = ((detail.link and detail.link.value) or '').strip()
+
+    if full_detail_address:
+        addr_parts = full_detail_address.split('\r\n')
+        formatted_detail['state'] = addr_parts[-2]
+        formatted_detail['full_address'] = " ".join([field for field in [
+            formatted_detail['street_address'],
+            formatted_detail['city'],
+            formatted_detail['state'],
+            formatted_detail['postal_code']
+        ] if field])
+    return formatted_detail
@@ -1,111 +1,181 @@
+import importlib.util
+import itertools
+import logging
 from pathlib import Path
+from typing import Iterable
 
-import requests
-from geopy import Nominatim
-from scrapy.exceptions import DropItem
+from scrapy import signals
+from scrapy.exceptions import DropItem, NotConfigured
 
-from charge_point_scrapers.constants import XLSX_OUT_FILE, SheetNames
-from charge_point_scrapers.utils import export_to_excel, fmt_co_charger_value
+from charge_point_scrapers.constants import (
+    XLSX_OUT_FILE, SheetNames, ZAP_MAP_COL_MAPPING, CO_CHARGER_COL_MAPPING
+)
+from charge_point_scrapers.exporters import ROW_WRITERS, requires_pyarrow
+from charge_point_scrapers.gazetteer import Gazetteer
+from charge_point_scrapers.geocoding import PostcodeCache, PostcodeEnricher
+from charge_point_scrapers.sharding import shard_path, spider_shard
+from charge_point_scrapers.store import ChargePointStore
+from charge_point_scrapers.utils import (
+    export_to_excel, fmt_co_charger_value, get_jsonl_feed_path, co_charger_radius_filter_enabled,
+    filter_co_charger_radius_in_chunks, radius_bounding_box, read_latest_feed_records
+)
 
 
 class ZapMapsPipeline:
 
     def __init__(self, crawler):
         self.crawler = crawler
-        self.seen_uids = set()
 
     @classmethod
     def from_crawler(cls, crawler):
         return cls(crawler)
 
     def process_item(self, item, spider):
-        if item['uuid'] not in self.seen_uids:
-            self.seen_uids.add(item['uuid'])
-        else:
+        # Points are emitted again when a deferred info request changes their address
+        is_patch = item.pop('extra_detail_patch', False)
+        if not spider.scraped_points.claim(item['uuid']) and not is_patch:
             raise DropItem(f"Duplicate item dropped {item}")
 
         return item
 
 
-class ZapMapsOutPipeline:
+class StorePipeline:
+    """
+    Upserts items into the spider's table of the CHARGE_POINT_STORE_FILE database, which the exports query when
+    the spider closes. The store is shared with the other pipelines as spider.store.
+    On the first crawl with the store, the points of the previous crawls are imported from the json lines feed.
+    """
+    key_field = ''
+    # Item fields copied into their own columns, with their sqlite types
+    indexed_fields = {}
+    indexes = []
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.store = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def open_spider(self, spider):
+        settings = self.crawler.settings
+        self.store = ChargePointStore(
+            shard_path(spider, Path(__file__).parent.parent / settings.get('CHARGE_POINT_STORE_FILE')),
+            table=spider.name,
+            key_field=self.key_field,
+            indexed_fields=self.indexed_fields,
+            indexes=self.indexes,
+            batch_size=settings.getint('CHARGE_POINT_STORE_BATCH_SIZE')
+        )
+        spider.store = self.store
+        # Other pipelines still use the store in close_spider
+        self.crawler.signals.connect(self.store.close, signal=signals.spider_closed)
+
+        jsonl_feed_path = get_jsonl_feed_path(settings)
+        if not len(self.store) and jsonl_feed_path and jsonl_feed_path.exists():
+            spider.logger.info(f"Importing previous points from {jsonl_feed_path}")
+            self.store.put_many(read_latest_feed_records(jsonl_feed_path, self.key_field))
+            spider.logger.info(f"Imported {len(self.store)} points")
+
+    def process_item(self, item, spider):
+        self.store.put(item)
+        return item
 
     def close_spider(self, spider):
-        root_dir = Path(__file__).parent.parent
-        feeds = spider.settings.get('FEEDS')
-        feed_paths = list(feeds.keys())
-        jsonl_feed_path = None
-        if feed_paths and feeds[feed_paths[0]]['format'] == 'jl':
-            jsonl_feed_path = root_dir / feed_paths[0]
-
-        if not jsonl_feed_path or not jsonl_feed_path.exists():
-            spider.logger.error("Failed to export. JL Feed export not found")
-            return
+        self.store.flush()
+        self.crawler.stats.set_value('store/items', len(self.store))
+
+
+class ZapMapsStorePipeline(StorePipeline):
+    key_field = 'uuid'
+    indexed_fields = {'postal_code': 'TEXT', 'operator_name': 'TEXT', 'state': 'TEXT', 'city': 'TEXT'}
+    indexes = [('postal_code',), ('operator_name',), ('state', 'city')]
+
 
-        excel_file_path = root_dir / XLSX_OUT_FILE
-        sheet_name = SheetNames.ZAP_MAP.value
-        col_mapping = {
-            'name': 'Name',
-            'full_address': 'Full Address',
-            'street_address': 'Street Address',
-            'city': 'City',
-            'state': 'County',
-            'postal_code': 'Post Code',
-            'phone_number': 'Phone Number',
-            'operator_name': 'Charge Point Operator Name',
-            'date_created': 'Date Created',
-            'date_updated': 'Date Updated',
-            'charging_fee': 'Charging fee',
-            'parking_fee': 'Parking fee',
-            'location_url': 'Location URL'
-        }
+class ExcelOutPipeline:
+    """
+    Writes the spider's stored points to its sheet of the Excel workbook when the spider closes.
+    Shards of a sharded crawl only hold part of the points, their exports are written by the merge
+    """
+    col_mapping = {}
+    sheet_name = ''
 
+    def export_records(self, spider) -> Iterable[dict]:
+        return spider.store.items()
+
+    def close_spider(self, spider):
+        if spider_shard(spider):
+            return
         export_to_excel(
-            excel_file_path=excel_file_path,
-            jsonl_feed_path=jsonl_feed_path,
-            col_mapping=col_mapping,
-            sheet_name=sheet_name,
+            excel_file_path=Path(__file__).parent.parent / XLSX_OUT_FILE,
+            records=self.export_records(spider),
+            col_mapping=self.col_mapping,
+            sheet_name=self.sheet_name,
             spider=spider
         )
 
 
+class ZapMapsOutPipeline(ExcelOutPipeline):
+    col_mapping = ZAP_MAP_COL_MAPPING
+    sheet_name = SheetNames.ZAP_MAP.value
+
+
 class CoChargerRawPipeline:
+    """
+    Drops duplicate and inactive hosts, fills in missing cities and counties from the host's post code and
+    formats the name and address.
+    Post code lookups run in the background so items that need one don't hold up the rest of the crawl.
+    """
+    invalid_values = ['', 'null', None]
+
     def __init__(self, crawler):
         self.crawler = crawler
-        self.seen_ids = set()
+        settings = crawler.settings
+        root_dir = Path(__file__).parent.parent
+        gazetteer_path = root_dir / settings.get('CO_CHARGER_GAZETTEER_FILE')
+        self.enricher = PostcodeEnricher(
+            PostcodeCache(
+                root_dir / settings.get('CO_CHARGER_GEOCODE_CACHE_FILE'),
+                ttl=settings.getint('CO_CHARGER_GEOCODE_CACHE_TTL_DAYS') * 24 * 60 * 60
+            ),
+            stats=crawler.stats,
+            logger=logging.getLogger(__name__),
+            concurrency=settings.getint('CO_CHARGER_GEOCODE_CONCURRENCY'),
+            min_interval=settings.getfloat('CO_CHARGER_GEOCODE_MIN_INTERVAL'),
+            gazetteer=Gazetteer(gazetteer_path) if gazetteer_path.exists() else None
+        )
 
     @classmethod
     def from_crawler(cls, crawler):
         return cls(crawler)
 
     def process_item(self, item, spider):
-        if item['id'] not in self.seen_ids:
-            self.seen_ids.add(item['id'])
-        else:
+        if not spider.scraped_hosts.claim(item['id']):
             raise DropItem(f"Duplicate item dropped {item}")
 
         if not item['status']:
             raise DropItem(f"Invalid host dropped {item}")
 
-        geolocator = Nominatim(user_agent='some random ua')
-        invalid_values = ['', 'null', None]
-        if item['city'] in invalid_values:
-            loc = geolocator.geocode(item['post_code'], addressdetails=True).raw
-            addr = loc['address']
-            city = addr.get('city') or \
-                addr.get('town') or \
-                addr.get('village') or \
-                addr.get('city_district') or \
-                addr.get('suburb') or \
-                addr.get('county')
-            if city:
-                item['city'] = city
+        needs_lookup = item['city'] in self.invalid_values or item['county'] in self.invalid_values
+        if needs_lookup and item['post_code'] not in self.invalid_values:
+            d = self.enricher.lookup(str(item['post_code']))
+            d.addCallback(self.enrich_item, item)
+            return d
+
+        return self.format_item(item)
 
-        if item['county'] in invalid_values:
-            res = requests.get(f"https://wikishire.co.uk/lookup/postcode?pc={item['post_code']}")
-            county = res.text
-            if county:
+    def enrich_item(self, location, item):
+        if location:
+            city, county = location
+            if item['city'] in self.invalid_values and city:
+                item['city'] = city
+            if item['county'] in self.invalid_values and county:
                 item['county'] = county
 
+        return self.format_item(item)
+
+    def format_item(self, item):
         first_name, last_name = fmt_co_charger_value(item['first_name']), fmt_co_charger_value(item['last_name'])
         name = f"{first_name} {last_name}".strip()
 
@@ -116,38 +186,95 @@ class CoChargerRawPipeline:
 
         return item
 
+    def close_spider(self, spider):
+        self.enricher.close()
+
+
+class CoChargerStorePipeline(StorePipeline):
+    key_field = 'id'
+    indexed_fields = {'post_code': 'TEXT', 'county': 'TEXT', 'city': 'TEXT', 'latitude': 'REAL', 'longitude': 'REAL'}
+    indexes = [('post_code',), ('county', 'city'), ('latitude', 'longitude')]
+
+
+def co_charger_export_records(spider) -> Iterable[dict]:
+    """
+    Stored hosts, only those within CO_CHARGER_RADIUS_LOCATIONS unless the radius filter is disabled.
+    Hosts are first selected by the bounding boxes of the radii, then filtered by their distance.
+    """
+    if not co_charger_radius_filter_enabled():
+        return spider.store.items()
+    locations = spider.settings.getdict('CO_CHARGER_RADIUS_LOCATIONS')
+    return filter_co_charger_radius_in_chunks(
+        spider.store.items_within_boxes(radius_bounding_box(*location) for location in locations.values()),
+        locations=locations,
+        exact_boundary=spider.settings.getbool('CO_CHARGER_RADIUS_EXACT_BOUNDARY')
+    )
 
-class CoChargerOutPipeline:
+
+class CoChargerOutPipeline(ExcelOutPipeline):
+    col_mapping = CO_CHARGER_COL_MAPPING
+    sheet_name = SheetNames.CO_CHARGER.value
+
+    def export_records(self, spider) -> Iterable[dict]:
+        return co_charger_export_records(spider)
+
+
+class ColumnarOutPipeline:
+    """
+    Writes the spider's stored points to the COLUMNAR_EXPORT_FORMATS (csv, parquet, feather) when the spider
+    closes, in batches of COLUMNAR_EXPORT_BATCH_SIZE, using the same columns as the Excel export plus the item key.
+    Output files are named after the spider, e.g. zap_maps.csv and zap_maps.parquet. Not written by shards
+    """
+    key_field = ''
+    col_mapping = {}
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.formats = crawler.settings.getlist('COLUMNAR_EXPORT_FORMATS')
+        if not self.formats:
+            raise NotConfigured
+        unknown_formats = set(self.formats) - set(ROW_WRITERS)
+        if unknown_formats:
+            raise NotConfigured(f"Unknown columnar export formats: {', '.join(unknown_formats)}")
+        arrow_formats = [fmt for fmt in self.formats if requires_pyarrow(fmt)]
+        if arrow_formats and importlib.util.find_spec('pyarrow') is None:
+            raise NotConfigured(f"pyarrow is required to export {', '.join(arrow_formats)} files")
+        self.batch_size = crawler.settings.getint('COLUMNAR_EXPORT_BATCH_SIZE')
+        self.keys = [self.key_field, *self.col_mapping]
+        self.columns = [self.key_field, *self.col_mapping.values()]
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def export_records(self, spider) -> Iterable[dict]:
+        return spider.store.items()
 
     def close_spider(self, spider):
-        root_dir = Path(__file__).parent.parent
-        feeds = spider.settings.get('FEEDS')
-        feed_paths = list(feeds.keys())
-        jsonl_feed_path = None
-        if feed_paths and feeds[feed_paths[0]]['format'] == 'jl':
-            jsonl_feed_path = root_dir / feed_paths[0]
-
-        if not jsonl_feed_path or not jsonl_feed_path.exists():
-            spider.logger.error("Failed to export. JL Feed export not found")
+        if spider_shard(spider):
             return
+        base_path = Path(__file__).parent.parent / spider.name
+        writers = [ROW_WRITERS[fmt](base_path, self.keys, self.columns) for fmt in self.formats]
+        records = iter(self.export_records(spider))
+        while True:
+            rows = [[record.get(key) for key in self.keys] for record in itertools.islice(records, self.batch_size)]
+            if not rows:
+                break
+            for writer in writers:
+                writer.write_batch(rows)
+            self.crawler.stats.inc_value('columnar_export/rows', len(rows))
+        for writer in writers:
+            writer.close()
 
-        excel_file_path = root_dir / XLSX_OUT_FILE
-        sheet_name = SheetNames.CO_CHARGER.value
-        col_mapping = {
-            'name': 'Name of the Host',
-            'address': 'Street Address',
-            'city': 'City',
-            'county': 'County',
-            'post_code': 'Post Code',
-            'mobile': 'Phone Number',
-            'charging_rate': 'Charging rate (kW)',
-            'charger_type': 'Connector type',
-            'charge_cost_rate': 'Rental charge (£/hour)',
-        }
-        export_to_excel(
-            excel_file_path=excel_file_path,
-            jsonl_feed_path=jsonl_feed_path,
-            col_mapping=col_mapping,
-            sheet_name=sheet_name,
-            spider=spider
-        )
+
+class ZapMapsColumnarOutPipeline(ColumnarOutPipeline):
+    key_field = 'uuid'
+    col_mapping = ZAP_MAP_COL_MAPPING
+
+
+class CoChargerColumnarOutPipeline(ColumnarOutPipeline):
+    key_field = 'id'
+    col_mapping = CO_CHARGER_COL_MAPPING
+
+    def export_records(self, spider) -> Iterable[dict]:
+        return co_charger_export_records(spider)
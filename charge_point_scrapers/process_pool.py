@@ -0,0 +1,108 @@
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Tuple
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+
+def _run_batch(func: Callable, calls: List[tuple]) -> Tuple[list, float]:
+    """Runs in the worker, returns (succeeded, result or exception) for each call and the seconds spent"""
+    started = time.perf_counter()
+    results = []
+    for args in calls:
+        try:
+            results.append((True, func(*args)))
+        except Exception as e:
+            results.append((False, e))
+    return results, time.perf_counter() - started
+
+
+class BatchedProcessPool:
+    """
+    Runs CPU bound functions off the reactor thread in a pool of processes. Calls are sent in batches of
+    batch_size, or whatever has queued up max_delay seconds after the first call of a batch, so the pickling and
+    IPC cost is paid per batch instead of per call. Functions must be importable module level functions.
+    With no processes calls run in place, so both modes report the same stats.
+    """
+
+    def __init__(self, processes: int, batch_size: int, max_delay: float):
+        self.processes = processes
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        # Spawned rather than forked, the reactor and its threads shouldn't be copied into the workers
+        self.executor = ProcessPoolExecutor(
+            processes, mp_context=multiprocessing.get_context('spawn')
+        ) if processes else None
+        # func -> [(args, Deferred)] of the calls waiting for their batch to be sent
+        self.batches: Dict[Callable, List[Tuple[tuple, defer.Deferred]]] = {}
+        self.flush_calls = {}
+        self.calls = 0
+        self.batches_sent = 0
+        self.busy_seconds = 0.0
+
+    def submit(self, func: Callable, *args) -> defer.Deferred:
+        if not self.executor:
+            started = time.perf_counter()
+            d = defer.maybeDeferred(func, *args)
+            self.calls += 1
+            self.busy_seconds += time.perf_counter() - started
+            return d
+
+        # Imported here rather than at module level, the spiders import this module and importing the reactor
+        # before Scrapy installs TWISTED_REACTOR would install the default one instead
+        from twisted.internet import reactor
+
+        d = defer.Deferred()
+        batch = self.batches.setdefault(func, [])
+        batch.append((args, d))
+        if len(batch) >= self.batch_size:
+            self.flush(func)
+        elif func not in self.flush_calls:
+            self.flush_calls[func] = reactor.callLater(self.max_delay, self.flush, func)
+        return d
+
+    def flush(self, func: Callable):
+        from twisted.internet import reactor
+
+        flush_call = self.flush_calls.pop(func, None)
+        if flush_call and flush_call.active():
+            flush_call.cancel()
+        batch = self.batches.pop(func, None)
+        if not batch:
+            return
+        self.batches_sent += 1
+        future = self.executor.submit(_run_batch, func, [args for args, _ in batch])
+        future.add_done_callback(lambda done: reactor.callFromThread(self.batch_done, batch, done))
+
+    def batch_done(self, batch: List[Tuple[tuple, defer.Deferred]], future):
+        try:
+            results, seconds = future.result()
+        except Exception:
+            failure = Failure()
+            for _, d in batch:
+                d.errback(failure)
+            return
+        self.calls += len(batch)
+        self.busy_seconds += seconds
+        for (_, d), (succeeded, result) in zip(batch, results):
+            if succeeded:
+                d.callback(result)
+            else:
+                d.errback(Failure(result))
+
+    def record_stats(self, stats, prefix: str):
+        """Throughput is in calls per second of a core's time, comparable between pool sizes and with no pool"""
+        stats.set_value(f'{prefix}/processes', self.processes)
+        stats.set_value(f'{prefix}/items', self.calls)
+        stats.set_value(f'{prefix}/batches', self.batches_sent)
+        stats.set_value(f'{prefix}/busy_seconds', round(self.busy_seconds, 3))
+        if self.busy_seconds:
+            stats.set_value(f'{prefix}/items_per_second_per_core', round(self.calls / self.busy_seconds, 1))
+
+    def close(self):
+        for func in list(self.flush_calls):
+            self.flush_calls.pop(func).cancel()
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,93 @@
+import random
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+# Weight of the newest sample in the latency and success rate moving averages
+EWMA_ALPHA = 0.2
+
+
+class ProxyState:
+    """Health of one proxy. Untried proxies start with a 1s latency and a 50% success rate"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.latency = 1.0
+        self.success_rate = 0.5
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self.quarantined_until = 0.0
+
+    @property
+    def weight(self) -> float:
+        return self.success_rate / max(self.latency, 0.05)
+
+    def is_available(self, now: float, max_concurrency: int) -> bool:
+        return self.quarantined_until <= now and self.in_flight < max_concurrency
+
+    def record(self, success: bool, latency: Optional[float] = None):
+        self.success_rate += EWMA_ALPHA * (float(success) - self.success_rate)
+        if latency is not None:
+            self.latency += EWMA_ALPHA * (latency - self.latency)
+        self.consecutive_failures = 0 if success else self.consecutive_failures + 1
+
+
+class ProxyPool:
+    """
+    Picks proxies at random weighted by health (success rate / latency), with at most max_concurrency requests
+    in flight per proxy. Proxies that fail or get banned are quarantined for base_backoff seconds, doubling
+    with each consecutive failure up to max_backoff.
+    """
+
+    def __init__(self, proxies: List[str], max_concurrency: int, base_backoff: float, max_backoff: float):
+        self.proxies: Dict[str, ProxyState] = {url: ProxyState(url) for url in proxies}
+        self.max_concurrency = max_concurrency
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+
+    @classmethod
+    def from_file(cls, path: Union[Path, str], **kwargs) -> 'ProxyPool':
+        """One ip:port or scheme://ip:port per line"""
+        with open(path, 'r', encoding='utf-8') as f:
+            lines = [line.strip() for line in f]
+        proxies = [line if '://' in line else f'http://{line}' for line in lines if line and not line.startswith('#')]
+        return cls(list(dict.fromkeys(proxies)), **kwargs)
+
+    def __len__(self) -> int:
+        return len(self.proxies)
+
+    def acquire(self) -> Optional[ProxyState]:
+        """A proxy with a free slot, or None if all of them are busy or quarantined"""
+        now = time.time()
+        available = [proxy for proxy in self.proxies.values() if proxy.is_available(now, self.max_concurrency)]
+        if not available:
+            return None
+        proxy = random.choices(available, weights=[proxy.weight for proxy in available])[0]
+        proxy.in_flight += 1
+        return proxy
+
+    def release(self, url: str, success: Optional[bool] = None, latency: Optional[float] = None) -> bool:
+        """
+        Free the proxy's slot, recording the outcome unless success is None.
+        Returns True if the proxy was quarantined
+        """
+        proxy = self.proxies[url]
+        proxy.in_flight -= 1
+        if success is None:
+            return False
+        proxy.record(success, latency)
+        if success:
+            return False
+        backoff = min(self.base_backoff * 2 ** (proxy.consecutive_failures - 1), self.max_backoff)
+        proxy.quarantined_until = time.time() + backoff
+        return True
+
+    def next_available_at(self) -> Optional[float]:
+        """When the first quarantined proxy is released, None if none is quarantined"""
+        now = time.time()
+        quarantined = [proxy.quarantined_until for proxy in self.proxies.values() if proxy.quarantined_until > now]
+        return min(quarantined) if quarantined else None
+
+    def available_count(self) -> int:
+        now = time.time()
+        return sum(proxy.quarantined_until <= now for proxy in self.proxies.values())
@@ -0,0 +1,70 @@
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+# Weight of the newest sample in the latency moving average
+EWMA_ALPHA = 0.1
+
+
+def parse_retry_after(value: Optional[bytes]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header, given either as seconds or as an HTTP date"""
+    if not value:
+        return None
+    value = value.decode('latin1').strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class AimdLimit:
+    """
+    Concurrency limit adjusted with additive increase / multiplicative decrease.
+    Each healthy response adds 1 / limit, so the limit grows by about one per round of requests while latency
+    stays within latency_tolerance times the lowest latency seen. Throttling responses and errors cut it by
+    decrease_factor, at most once per round trip so one burst of errors only counts once.
+    """
+
+    def __init__(
+            self,
+            start: float,
+            minimum: float,
+            maximum: float,
+            decrease_factor: float,
+            latency_tolerance: float
+    ):
+        self.limit = start
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.latency = None
+        self.min_latency = None
+        self.last_decrease = 0.0
+        self.paused_until = 0.0
+
+    @property
+    def concurrency(self) -> int:
+        return max(1, int(self.limit))
+
+    def record_latency(self, latency: float):
+        self.latency = latency if self.latency is None else self.latency + EWMA_ALPHA * (latency - self.latency)
+        self.min_latency = self.latency if self.min_latency is None else min(self.min_latency, self.latency)
+
+    def on_success(self, latency: float):
+        self.record_latency(latency)
+        if self.latency <= self.min_latency * self.latency_tolerance:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def on_congestion(self, retry_after: Optional[float] = None) -> bool:
+        """Returns True if the limit was cut"""
+        now = time.time()
+        if retry_after:
+            self.paused_until = max(self.paused_until, now + retry_after)
+        if now - self.last_decrease < (self.latency or 1.0):
+            return False
+        self.limit = max(self.minimum, self.limit * self.decrease_factor)
+        self.last_decrease = now
+        return True
@@ -0,0 +1,101 @@
+import json
+import sqlite3
+import time
+import zlib
+from pathlib import Path
+from typing import NamedTuple, Optional, Union
+
+
+class CachedResponse(NamedTuple):
+    status: int
+    headers: dict
+    body: bytes
+    version: Optional[str]
+    etag: Optional[str]
+    last_modified: Optional[str]
+    stored_at: int
+
+
+class ResponseCache:
+    """
+    Persistent url -> response cache. Headers and bodies are stored zlib compressed and once the compressed size
+    of all entries passes max_bytes the least recently used ones are evicted.
+    Each entry can hold a version, e.g. a fingerprint of the listing fields of the point it describes, that
+    callers compare to tell whether the entry is out of date regardless of its age.
+    """
+    COMMIT_EVERY = 100
+    # Evict down to this share of max_bytes so eviction doesn't run on every store
+    EVICT_TO = 0.9
+
+    def __init__(self, path: Union[Path, str], max_bytes: int):
+        self.max_bytes = max_bytes
+        # Crawls running side by side, e.g. shards on one host, share the cache
+        self.conn = sqlite3.connect(str(path), timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, status INTEGER, headers BLOB, body BLOB, '
+            'version TEXT, etag TEXT, last_modified TEXT, stored_at INTEGER, accessed_at INTEGER, size INTEGER)'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)')
+        self.total_bytes = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        self.uncommitted = 0
+
+    def get(self, url: str) -> Optional[CachedResponse]:
+        row = self.conn.execute(
+            'SELECT status, headers, body, version, etag, last_modified, stored_at FROM responses WHERE url = ?',
+            (url,)
+        ).fetchone()
+        if not row:
+            return None
+        self._execute('UPDATE responses SET accessed_at = ? WHERE url = ?', (int(time.time()), url))
+        status, headers, body, *validators = row
+        return CachedResponse(status, json.loads(zlib.decompress(headers)), zlib.decompress(body), *validators)
+
+    def set(self, url: str, status: int, headers: dict, body: bytes, version: Optional[str] = None) -> int:
+        """Store a response, returns the number of entries evicted to make room for it"""
+        compressed_headers = zlib.compress(json.dumps(headers).encode('utf-8'))
+        compressed_body = zlib.compress(body)
+        size = len(compressed_headers) + len(compressed_body)
+        etag = (headers.get('Etag') or [None])[0]
+        last_modified = (headers.get('Last-Modified') or [None])[0]
+        now = int(time.time())
+
+        previous = self.conn.execute('SELECT size FROM responses WHERE url = ?', (url,)).fetchone()
+        self.total_bytes += size - (previous[0] if previous else 0)
+        self._execute(
+            'INSERT OR REPLACE INTO responses '
+            '(url, status, headers, body, version, etag, last_modified, stored_at, accessed_at, size) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (url, status, compressed_headers, compressed_body, version, etag, last_modified, now, now, size)
+        )
+        return self.evict() if self.total_bytes > self.max_bytes else 0
+
+    def refresh(self, url: str, version: Optional[str] = None):
+        """Mark an entry as fresh again after the server confirmed it's unchanged"""
+        self._execute('UPDATE responses SET stored_at = ?, version = ? WHERE url = ?', (int(time.time()), version, url))
+
+    def evict(self) -> int:
+        evicted = 0
+        rows = self.conn.execute('SELECT url, size FROM responses ORDER BY accessed_at').fetchall()
+        for url, size in rows:
+            if self.total_bytes <= self.max_bytes * self.EVICT_TO:
+                break
+            self.conn.execute('DELETE FROM responses WHERE url = ?', (url,))
+            self.total_bytes -= size
+            evicted += 1
+        self.commit()
+        return evicted
+
+    def _execute(self, sql: str, params: tuple):
+        self.conn.execute(sql, params)
+        self.uncommitted += 1
+        if self.uncommitted >= self.COMMIT_EVERY:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
@@ -0,0 +1,211 @@
+import json
+import sqlite3
+from pathlib import Path
+from typing import Iterator, Optional, Union
+
+from scrapy import Spider, signals
+
+from charge_point_scrapers.dedup import load_id_set, new_id_set, record_id_set_stats
+from charge_point_scrapers.sharding import shard_path, spider_shard
+from charge_point_scrapers.utils import get_jsonl_feed_path
+
+
+class ResumeIndex:
+    """
+    Sidecar index of the ids already exported to a json lines feed, so that resumed crawls can skip them
+    without parsing the whole feed on startup. Each id can also hold a fingerprint of its listing fields
+    that delta crawls compare against to find changed points.
+    Ids are added as items are scraped. The feed offset indexed so far is stored with the ids and on startup
+    only the lines appended after it, e.g. by a crawl that crashed or from before the index existed, are read.
+
+    Membership is checked against a compact in memory copy of the ids, see dedup.py, saved next to the index as
+    <index>.ids so it doesn't have to be rebuilt on startup. With the bloom backend, hits are confirmed against
+    the index since they may be false positives or ids removed by tombstones. The index is shared with the pipelines, which
+    claim() each id as its item comes through to drop duplicates scraped in the same crawl.
+    Startup is benchmarked against parsing the whole feed by python -m charge_point_scrapers.benchmarks
+    """
+    COMMIT_EVERY = 1000
+
+    def __init__(self, path: Union[Path, str], key: str, settings):
+        self.path = path
+        self.key = key
+        self.settings = settings
+        self.conn = sqlite3.connect(str(path))
+        self.conn.execute('CREATE TABLE IF NOT EXISTS seen_ids (id TEXT PRIMARY KEY, fingerprint TEXT) WITHOUT ROWID')
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(seen_ids)')]
+        if 'fingerprint' not in columns:
+            self.conn.execute('ALTER TABLE seen_ids ADD COLUMN fingerprint TEXT')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID')
+        self.uncommitted = 0
+        self.false_positives = 0
+        self.ids = self.load_ids()
+        self.crawl_ids = new_id_set(settings)
+
+    @property
+    def ids_path(self) -> Union[Path, None]:
+        return None if self.path == ':memory:' else Path(f'{self.path}.ids')
+
+    def load_ids(self):
+        """The saved ids if they match the index and the DEDUP_BACKEND setting, otherwise rebuilt from the index"""
+        count = len(self)
+        ids = new_id_set(self.settings, count)
+        if self.ids_path and self.ids_path.exists() and self.get_meta('ids_count') == str(count):
+            saved_ids = load_id_set(self.ids_path)
+            if type(saved_ids) is type(ids):
+                return saved_ids
+        ids.update(self)
+        return ids
+
+    def __contains__(self, item_id) -> bool:
+        if item_id not in self.ids:
+            return False
+        if self.ids.exact:
+            return True
+        stored = self.conn.execute('SELECT 1 FROM seen_ids WHERE id = ?', (str(item_id),)).fetchone() is not None
+        if not stored:
+            self.false_positives += 1
+        return stored
+
+    def claim(self, item_id) -> bool:
+        """False if the id was already claimed in this crawl"""
+        return self.crawl_ids.add(item_id)
+
+    def __len__(self) -> int:
+        return self.conn.execute('SELECT COUNT(*) FROM seen_ids').fetchone()[0]
+
+    def __iter__(self) -> Iterator[str]:
+        return (row[0] for row in self.conn.execute('SELECT id FROM seen_ids'))
+
+    def add(self, item_id):
+        self.ids.add(item_id)
+        self._execute('INSERT OR IGNORE INTO seen_ids (id) VALUES (?)', (str(item_id),))
+
+    def remove(self, item_id):
+        self.ids.discard(item_id)
+        self._execute('DELETE FROM seen_ids WHERE id = ?', (str(item_id),))
+
+    def merge(self, path: Union[Path, str]) -> int:
+        """Add the ids and fingerprints of another index, e.g. a shard's. Returns the number of ids added"""
+        self.commit()
+        count = len(self)
+        self.conn.execute('ATTACH DATABASE ? AS other', (str(path),))
+        try:
+            with self.conn:
+                self.conn.execute(
+                    'INSERT INTO seen_ids (id, fingerprint) SELECT id, fingerprint FROM other.seen_ids WHERE true '
+                    'ON CONFLICT(id) DO UPDATE SET fingerprint = COALESCE(excluded.fingerprint, seen_ids.fingerprint)'
+                )
+        finally:
+            self.conn.execute('DETACH DATABASE other')
+        self.ids = new_id_set(self.settings, len(self))
+        self.ids.update(self)
+        return len(self) - count
+
+    def get_fingerprint(self, item_id) -> Optional[str]:
+        """None if the id hasn't been seen, empty if it was seen before fingerprints were kept"""
+        row = self.conn.execute('SELECT fingerprint FROM seen_ids WHERE id = ?', (str(item_id),)).fetchone()
+        if row is None:
+            return None
+        return row[0] or ''
+
+    def set_fingerprint(self, item_id, fingerprint: str):
+        self.ids.add(item_id)
+        self._execute(
+            'INSERT INTO seen_ids (id, fingerprint) VALUES (?, ?) '
+            'ON CONFLICT(id) DO UPDATE SET fingerprint = excluded.fingerprint',
+            (str(item_id), fingerprint)
+        )
+
+    def _execute(self, sql: str, params: tuple):
+        self.conn.execute(sql, params)
+        self.uncommitted += 1
+        if self.uncommitted >= self.COMMIT_EVERY:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self.uncommitted = 0
+
+    def get_meta(self, key: str):
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value):
+        self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+
+    def sync_with_feed(self, feed_path: Path):
+        """
+        Index the lines appended to the feed since it was last indexed. Re-indexes a replaced feed. An index that
+        hasn't been synced with a feed yet, e.g. one the shards were merged into, keeps its ids
+        """
+        feed_size = feed_path.stat().st_size
+        offset = int(self.get_meta('feed_offset') or 0)
+        indexed_feed_path = self.get_meta('feed_path')
+        if (indexed_feed_path is not None and indexed_feed_path != str(feed_path)) or feed_size < offset:
+            self.conn.execute('DELETE FROM seen_ids')
+            self.ids = new_id_set(self.settings)
+            offset = 0
+
+        with open(feed_path, 'rb') as f:
+            f.seek(offset)
+            if offset:
+                # The last sync may have stopped in the middle of a line that was still being written
+                f.seek(offset - 1)
+                if f.read(1) != b'\n':
+                    f.readline()
+            for line in f:
+                if line.endswith(b'\n'):
+                    self.index_item(json.loads(line))
+                    offset = f.tell()
+
+        self.set_meta('feed_path', feed_path)
+        self.set_meta('feed_offset', offset)
+        self.commit()
+
+    def item_scraped(self, item, spider):
+        self.index_item(item)
+
+    def index_item(self, item):
+        if item.get('deleted'):
+            self.remove(item[self.key])
+        else:
+            self.add(item[self.key])
+
+    def close(self, feed_path: Union[Path, None] = None):
+        if feed_path and feed_path.exists():
+            # Items scraped this run are already indexed. Anything the exporter hasn't flushed yet is
+            # picked up by the next sync
+            self.set_meta('feed_path', feed_path)
+            self.set_meta('feed_offset', feed_path.stat().st_size)
+        if self.ids_path:
+            self.ids.save(self.ids_path)
+            self.set_meta('ids_count', len(self))
+        self.commit()
+        self.conn.close()
+
+
+def open_resume_index(spider: Spider, key: str) -> ResumeIndex:
+    """
+    Open the resume index for the spider's json lines feed, kept next to it as <feed>.idx
+    Without a json lines feed the index is kept as <spider>.idx, as it is for shards so the merge can find it
+    """
+    feed_path = get_jsonl_feed_path(spider.settings)
+    if feed_path and not spider_shard(spider):
+        index_path = feed_path.with_name(f'{feed_path.name}.idx')
+    else:
+        index_path = shard_path(spider, Path(__file__).parent.parent / f'{spider.name}.idx')
+    index = ResumeIndex(index_path, key, spider.settings)
+    if feed_path and feed_path.exists():
+        spider.logger.info(f"Found previous feed export at: {feed_path}")
+        index.sync_with_feed(feed_path)
+
+    def close():
+        record_id_set_stats(spider.crawler.stats, 'dedup/scraped', index.ids)
+        record_id_set_stats(spider.crawler.stats, 'dedup/crawl', index.crawl_ids)
+        if not index.ids.exact:
+            spider.crawler.stats.set_value('dedup/scraped/false_positives', index.false_positives)
+        index.close(feed_path)
+
+    spider.crawler.signals.connect(index.item_scraped, signal=signals.item_scraped)
+    spider.crawler.signals.connect(close, signal=signals.spider_closed, weak=False)
+    return index
@@ -0,0 +1,130 @@
+"""
+Typed schemas of the API responses the spiders read, decoded straight from response.body with msgspec.
+Only the fields the scrapers use are declared, the decoder skips everything else without building it. Co Charger hosts
+are the exception, they're exported with every field the API sends.
+Apart from the ids the spiders key on, every field may be missing or null so that one odd value doesn't lose the
+whole point, the normalisation functions fall back to empty values as the dict based parsing did.
+Benchmarked against json.loads by python -m charge_point_scrapers.benchmarks
+"""
+from typing import Any, Dict, List, Optional, Union
+
+import msgspec
+
+
+class Schema(msgspec.Struct):
+    pass
+
+
+# Zap Map bounding box search
+
+class BoundingBoxPoint(Schema):
+    uuid: str
+    legacy_id: int
+    created_at: Optional[str] = None
+    updated_at: Optional[str] = None
+
+
+class BoundingBoxMeta(Schema):
+    total: int
+    last_page: int
+    current_page: int
+
+
+class BoundingBoxResponse(Schema):
+    data: List[BoundingBoxPoint]
+    meta: BoundingBoxMeta
+
+
+# Zap Map location details
+
+class Parking(Schema):
+    # Free text or a number, as entered by the operator
+    fee: Any = None
+
+
+class PaymentDetails(Schema):
+    pricing: Any = None
+
+
+class Device(Schema):
+    payment_details: Optional[PaymentDetails] = None
+
+
+class Operator(Schema):
+    name: Optional[str] = None
+
+
+class Owner(Schema):
+    telephone_number: Optional[str] = None
+
+
+class LocationDetails(Schema):
+    uuid: str
+    name: Optional[str] = None
+    country: Optional[str] = None
+    updated_at: Optional[str] = None
+    city: Optional[str] = None
+    state: Optional[str] = None
+    address: Optional[str] = None
+    postal_code: Optional[str] = None
+    parking: Optional[Parking] = None
+    devices: Optional[List[Device]] = None
+    operator: Optional[Operator] = None
+    owner: Optional[Owner] = None
+
+
+class LocationDetailsResponse(Schema):
+    data: LocationDetails
+
+
+# Zap Map v5 point info
+
+class InfoMarker(Schema):
+    id: Optional[int] = None
+
+
+class InfoLink(Schema):
+    value: Optional[str] = None
+
+
+class InfoDetail(Schema):
+    marker: Optional[InfoMarker] = None
+    description: Optional[str] = None
+    link: Optional[InfoLink] = None
+
+
+class InfoDetails(Schema):
+    details: Optional[List[InfoDetail]] = None
+
+
+class LocationInfo(Schema):
+    data: Optional[InfoDetails] = None
+
+
+class InfoResources(Schema):
+    chargepoint_location_info: Optional[LocationInfo] = None
+
+
+class PointInfoResponse(Schema):
+    # Missing from the empty responses sent for points without any info
+    resources: Optional[InfoResources] = None
+
+
+# Co Charger
+
+class LoginResponse(Schema):
+    token: Optional[str] = None
+
+
+class HostSearchResponse(Schema):
+    # Hosts are exported whole and the API mixes up strings, numbers and 'null' strings in any of their fields, so
+    # they're passed on as sent rather than typed, CoChargerSpider.parse_hosts checks the fields the pipeline needs
+    hosts: List[Dict[str, Any]] = []
+
+
+BOUNDING_BOX_DECODER = msgspec.json.Decoder(BoundingBoxResponse)
+LOCATION_DETAILS_DECODER = msgspec.json.Decoder(LocationDetailsResponse)
+# Empty info responses come as [] or null
+POINT_INFO_DECODER = msgspec.json.Decoder(Union[PointInfoResponse, List[Any], None])
+LOGIN_DECODER = msgspec.json.Decoder(LoginResponse)
+HOST_SEARCH_DECODER = msgspec.json.Decoder(HostSearchResponse)
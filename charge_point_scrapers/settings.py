@@ -59,6 +59,106 @@ ROBOTSTXT_OBEY = False
 RETRY_TIMES = 3
 RETRY_HTTP_CODES = [500, 503, 502, 504, 400, 403, 404, 408]
 
+# Send requests through the proxies in PROXY_POOL_FILE, see ProxyPoolMiddleware
+PROXY_POOL_ENABLED = False
+PROXY_POOL_FILE = 'charge_point_scrapers/proxies.txt'
+PROXY_POOL_MAX_CONCURRENCY_PER_PROXY = 2
+# Responses that mean the proxy is banned, the request is sent again through another proxy
+PROXY_POOL_BAN_CODES = [403, 429]
+PROXY_POOL_MAX_SWITCHES = 5
+# Seconds a failing proxy is quarantined for, doubling with each consecutive failure
+PROXY_POOL_BASE_BACKOFF = 30
+PROXY_POOL_MAX_BACKOFF = 1800
+
+# How many times a Zap Map search tile may be split into 10x10 sub tiles while it has more than 250 points.
+# Depth 0 tiles are 1 degree, depth 3 tiles are 0.001 degrees (~100m)
+ZAP_MAP_MAX_TILE_DEPTH = 3
+# Tile pages requested at a time. The rest wait in the spider, points found are fetched first
+ZAP_MAP_MAX_OUTSTANDING_TILE_REQUESTS = 32
+# Tile density index saved at the end of each Zap Map crawl and used to plan the next one
+ZAP_MAP_TILE_INDEX_FILE = 'zap_maps.tiles.json'
+# Tile index records older than this are probed again from the top level
+ZAP_MAP_TILE_INDEX_MAX_AGE_DAYS = 30
+# Times a failed tile page is queued again, on top of RETRY_TIMES. Pages still failing are kept in the frontier
+ZAP_MAP_TILE_PAGE_RETRIES = 2
+# Re-scrape points whose created_at/updated_at changed since they were scraped and emit
+# {"uuid": ..., "deleted": true} tombstones for points no longer listed
+ZAP_MAP_DELTA_MODE = False
+# Checkpoint of the Zap Map crawl frontier, saved every ZAP_MAP_FRONTIER_CHECKPOINT_INTERVAL seconds and when the crawl
+# is interrupted, so the next crawl resumes from it. Kept in JOBDIR when set, removed once a crawl finishes
+ZAP_MAP_FRONTIER_FILE = 'zap_maps.frontier.json'
+ZAP_MAP_FRONTIER_CHECKPOINT_INTERVAL = 60
+ZAP_MAP_RESUME_FRONTIER = True
+# Frontiers older than this are ignored and the crawl starts over
+ZAP_MAP_FRONTIER_MAX_AGE_HOURS = 72
+
+# Worker processes that turn Zap Map detail responses into items, 0 to do it in the reactor thread.
+# Responses are sent to them in batches of NORMALISATION_BATCH_SIZE, or after NORMALISATION_MAX_DELAY seconds
+NORMALISATION_PROCESSES = 0
+NORMALISATION_BATCH_SIZE = 32
+NORMALISATION_MAX_DELAY = 0.05
+
+# Seconds before the Zap Map guest token expires that a new one is fetched, see ZapMapAuthMiddleware
+ZAP_MAP_TOKEN_REFRESH_MARGIN = 300
+# Lifetime assumed for tokens whose expiry can't be read
+ZAP_MAP_TOKEN_DEFAULT_TTL = 1800
+# Times a request rejected with a 401 is sent again with a new token
+ZAP_MAP_AUTH_MAX_REPLAYS = 2
+
+# When to request the Zap Map info endpoint, which only refines the county and location URL of a point:
+# 'always', 'never', 'missing_state' (points without a county) or 'deferred' (after the main crawl, re-emitting the
+# points whose address changed)
+ZAP_MAP_EXTRA_DETAIL_POLICY = 'always'
+
+# Cache of Zap Map location detail and info responses, see DetailResponseCacheMiddleware
+ZAP_MAP_DETAIL_CACHE_ENABLED = True
+ZAP_MAP_DETAIL_CACHE_FILE = 'zap_maps.responses.sqlite3'
+# Days a cached response is used without asking the API whether it changed, per endpoint
+ZAP_MAP_DETAIL_CACHE_TTL_DAYS = {'details': 7, 'extra_details': 30}
+# Least recently used responses are evicted once the compressed cache is bigger than this
+ZAP_MAP_DETAIL_CACHE_MAX_MB = 512
+
+# Post code -> (city, county) lookups for Co Charger hosts missing either one
+CO_CHARGER_GEOCODE_CACHE_FILE = 'co_charger.geocode.sqlite3'
+CO_CHARGER_GEOCODE_CACHE_TTL_DAYS = 90
+CO_CHARGER_GEOCODE_CONCURRENCY = 2
+# Nominatim allows at most 1 request per second
+CO_CHARGER_GEOCODE_MIN_INTERVAL = 1.0
+# Offline postcode gazetteer checked before any network lookup, see charge_point_scrapers/gazetteer.py
+CO_CHARGER_GAZETTEER_FILE = 'postcodes.gaz'
+
+# Unless CO_CHARGER_IGNORE_20_MILE_RADIUS=1, only Co Charger hosts within the radius of one of these
+# locations are exported. {name: (latitude, longitude, radius in miles)}
+CO_CHARGER_RADIUS_LOCATIONS = {
+    'Peterborough': (52.573552730184225, -0.25514820758860557, 21.0),
+    'Oxfordshire': (51.74383552545767, -1.2459381017248494, 21.0),
+    'Wimbledon': (51.42990367179369, -0.22438352969388295, 21.0),
+    'Bristol': (51.455539352076414, -2.5872982645856237, 21.0),
+    'Birmingham': (52.494308381894776, -1.8718849325622116, 21.0),
+    'Manchester': (53.48602564820113, -2.2399557350492376, 21.0),
+    'Milton Keynes': (52.040187985429135, -0.7580044689136244, 21.0),
+    'Reading': (51.45420910597151, -0.9802584269217173, 21.0),
+}
+# Re-check hosts within the haversine error margin of a radius with the exact geodesic distance
+CO_CHARGER_RADIUS_EXACT_BOUNDARY = True
+
+# In memory set of scraped ids used to skip points scraped by previous crawls and drop duplicates,
+# 'hashset' (exact, 36-72 bytes per id) or 'bloom' (2-3 bytes per id, with DEDUP_BLOOM_ERROR_RATE false positives,
+# i.e. points wrongly skipped as already scraped)
+DEDUP_BACKEND = 'hashset'
+DEDUP_BLOOM_ERROR_RATE = 0.001
+
+# SQLite database holding the latest version of every scraped point, one table per spider. Exports are built from it
+CHARGE_POINT_STORE_FILE = 'charge_points.sqlite3'
+# Items upserted per transaction
+CHARGE_POINT_STORE_BATCH_SIZE = 1000
+
+# Columnar exports written alongside the Excel workbook, any of 'csv', 'parquet', 'feather'.
+# parquet and feather need pyarrow
+COLUMNAR_EXPORT_FORMATS = []
+# Rows written per batch, each batch is a parquet row group / feather record batch
+COLUMNAR_EXPORT_BATCH_SIZE = 5000
+
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
 #EXTENSIONS = {
@@ -70,17 +170,31 @@ RETRY_HTTP_CODES = [500, 503, 502, 504, 400, 403, 404, 408]
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
-AUTOTHROTTLE_ENABLED = True
+# Replaced by AdaptiveRateMiddleware, which limits each host and endpoint separately
+#AUTOTHROTTLE_ENABLED = True
 # The initial download delay
-AUTOTHROTTLE_START_DELAY = 0
+#AUTOTHROTTLE_START_DELAY = 0
 # The maximum download delay to be set in case of high latencies
-AUTOTHROTTLE_MAX_DELAY = 5
+#AUTOTHROTTLE_MAX_DELAY = 5
 # The average number of requests Scrapy should be sending in parallel to
 # each remote server
-AUTOTHROTTLE_TARGET_CONCURRENCY = 50.0
+#AUTOTHROTTLE_TARGET_CONCURRENCY = 50.0
 # Enable showing throttling stats for every response received:
 #AUTOTHROTTLE_DEBUG = False
 
+# Per host and endpoint concurrency limits, see AdaptiveRateMiddleware
+ADAPTIVE_RATE_ENABLED = True
+ADAPTIVE_RATE_START_CONCURRENCY = 4
+ADAPTIVE_RATE_MIN_CONCURRENCY = 1
+ADAPTIVE_RATE_MAX_CONCURRENCY = 64
+# Share of the limit kept when the API throttles or errors
+ADAPTIVE_RATE_DECREASE_FACTOR = 0.5
+# Limits only grow while latency is within this many times the lowest latency seen
+ADAPTIVE_RATE_LATENCY_TOLERANCE = 2.0
+ADAPTIVE_RATE_THROTTLE_CODES = [429, 503]
+# Longest pause honoured from a Retry-After header, in seconds
+ADAPTIVE_RATE_MAX_RETRY_AFTER = 300
+
 # Enable and configure HTTP caching (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html#httpcache-middleware-settings
 #HTTPCACHE_ENABLED = True
@@ -0,0 +1,42 @@
+import re
+import zlib
+from pathlib import Path
+from typing import NamedTuple, Optional, Union
+
+from charge_point_scrapers.tiling import Tile
+
+
+class Shard(NamedTuple):
+    """
+    One of count workers splitting a crawl between them, given to the spider as -a shard=<index>/<count>, e.g.
+    -a shard=0/4. Each top level tile belongs to one shard, sub tiles go with their top level tile.
+    Shards keep their store, resume index, tile index and frontier in their own files, see path()
+    """
+    index: int
+    count: int
+
+    @classmethod
+    def parse(cls, value: str) -> 'Shard':
+        match = re.fullmatch(r'(\d+)/(\d+)', value.strip())
+        if not match or int(match[1]) >= int(match[2]):
+            raise ValueError(f"shard must be <index>/<count> with index < count, e.g. 0/4, not {value}")
+        return cls(int(match[1]), int(match[2]))
+
+    def owns(self, tile: Tile) -> bool:
+        return zlib.crc32(str(tile).encode('ascii')) % self.count == self.index
+
+    def path(self, path: Union[Path, str]) -> Path:
+        """The shard's copy of a file, e.g. zap_maps.tiles.json -> zap_maps.shard-0-of-4.tiles.json"""
+        path = Path(path)
+        stem, dot, suffixes = path.name.partition('.')
+        return path.with_name(f'{stem}.shard-{self.index}-of-{self.count}{dot}{suffixes}')
+
+
+def spider_shard(spider) -> Optional[Shard]:
+    return getattr(spider, 'shard', None)
+
+
+def shard_path(spider, path: Union[Path, str]) -> Path:
+    """The path as is, or the shard's copy of it when the spider is one shard of a crawl"""
+    shard = spider_shard(spider)
+    return shard.path(path) if shard else Path(path)
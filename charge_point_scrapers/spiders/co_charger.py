@@ -1,6 +1,4 @@
-import json
 import os
-from pathlib import Path
 
 import requests
 import scrapy
@@ -9,9 +7,17 @@ from scrapy import Request
 from geopy.geocoders import Nominatim
 
 from charge_point_scrapers.constants import CO_CHARGER_REQUEST_HEADERS, EnvKeys
+from charge_point_scrapers.resume import open_resume_index
+from charge_point_scrapers.schemas import HOST_SEARCH_DECODER, LOGIN_DECODER
 from charge_point_scrapers.utils import authenticate_co_charger, update_co_charger_auth_token
 
 
+# Read by CoChargerRawPipeline, hosts are passed on with every other field the API sends as is
+PIPELINE_FIELDS = (
+    'status', 'first_name', 'last_name', 'address_line_1', 'address_line_2', 'city', 'county', 'post_code'
+)
+
+
 class CoChargerSpider(scrapy.Spider):
     name = "co_charger"
     # handle_httpstatus_list = [401, 403]
@@ -21,7 +27,13 @@ class CoChargerSpider(scrapy.Spider):
         'RETRY_TIMES': 3,
         'ITEM_PIPELINES': {
             'charge_point_scrapers.pipelines.CoChargerRawPipeline': 100,
+            'charge_point_scrapers.pipelines.CoChargerStorePipeline': 200,
+            'charge_point_scrapers.pipelines.CoChargerColumnarOutPipeline': 99998,
             'charge_point_scrapers.pipelines.CoChargerOutPipeline': 99999,
+        },
+        'DOWNLOADER_MIDDLEWARES': {
+            'charge_point_scrapers.middlewares.AdaptiveRateMiddleware': 940,
+            'charge_point_scrapers.middlewares.ProxyPoolMiddleware': 960,
         }
     }
     auth_headers = {}
@@ -34,22 +46,8 @@ class CoChargerSpider(scrapy.Spider):
         )
 
     def start_requests(self):
-        self.scraped_hosts = {}
-        root_dir = Path(__file__).parent.parent.parent
-        feeds = self.settings.get('FEEDS')
-        feed_paths = list(feeds.keys())
-        jsonl_feed_path = None
-        if feed_paths and feeds[feed_paths[0]]['format'] == 'jl':
-            jsonl_feed_path = root_dir / feed_paths[0]
-
-        if jsonl_feed_path and jsonl_feed_path.exists():
-            self.logger.info(f"Found previous feed export at: {jsonl_feed_path}")
-            with open(jsonl_feed_path, 'r', encoding='utf-8') as f:
-                for line in f.readlines():
-                    line_data = json.loads(line)
-                    self.scraped_hosts[line_data['id']] = 1
-
-        self.logger.info(f"Loaded {len(self.scraped_hosts.keys())} scraped points")
+        self.scraped_hosts = open_resume_index(self, 'id')
+        self.logger.info(f"Loaded {len(self.scraped_hosts)} scraped points")
 
         load_dotenv()
         co_charger_token = os.getenv(EnvKeys.CO_CHARGER_TOKEN.value)
@@ -59,14 +57,20 @@ class CoChargerSpider(scrapy.Spider):
             yield authenticate_co_charger(callback=self.parse_login)
 
     def parse_login(self, response):
-        parsed_res = json.loads(response.text)
-        if 'token' in parsed_res:
-            auth_token = parsed_res['token']
+        parsed_res = LOGIN_DECODER.decode(response.body)
+        if parsed_res.token is not None:
+            auth_token = parsed_res.token
             update_co_charger_auth_token(auth_token)
             yield self.get_charging_hosts(auth_token)
 
     def parse_hosts(self, response):
-        parsed_res = json.loads(response.text)
-        for host in parsed_res['hosts']:
+        parsed_res = HOST_SEARCH_DECODER.decode(response.body)
+        for host in parsed_res.hosts:
+            if host.get('id') is None:
+                self.logger.warning(f"Host without an id skipped {host}")
+                continue
+
             if host['id'] not in self.scraped_hosts:
+                for field in PIPELINE_FIELDS:
+                    host.setdefault(field, None)
                 yield host
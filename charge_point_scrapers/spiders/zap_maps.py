@@ -1,22 +1,34 @@
-import json
+import datetime
+import heapq
+import itertools
+import time
+from collections import Counter
 from pathlib import Path
+from typing import Optional
 
 import scrapy
-from scrapy import Request
+from scrapy import Request, signals
+from scrapy.exceptions import DontCloseSpider
 from scrapy.http import Response
+from scrapy.utils.defer import maybe_deferred_to_future
+from twisted.internet import task
 
 
+from charge_point_scrapers.dedup import new_id_set, record_id_set_stats
 from charge_point_scrapers.constants import (
-    WESTERN_MOST_LONGITUDE_UK,
-    EASTERN_MOST_LONGITUDE_UK,
-    NORTHERN_MOST_LATITUDE_UK,
-    SOUTHERN_MOST_LATITUDE_UK,
     BOUNDING_BOX_FILTER_URL,
+    BOUNDING_BOX_RESULTS_CAP,
     ZAP_MAP_REQUEST_HEADERS,
-    CHARGE_POINT_DETAILS_ENDPOINT, CHARGE_POINT_EXTRA_DETAILS_ENDPOINT, ZAP_MAP_V5_POINT_INFO_HEADERS,
-    FULL_ADDRESS_MARKER, LOCATION_URL_MARKER
+    CHARGE_POINT_DETAILS_ENDPOINT, CHARGE_POINT_EXTRA_DETAILS_ENDPOINT, ZAP_MAP_V5_POINT_INFO_HEADERS
 )
-from charge_point_scrapers.utils import copy_headers, request_zap_auth_token, parse_date
+from charge_point_scrapers.frontier import Frontier, PendingDetail, TilePage
+from charge_point_scrapers.normalisation import apply_extra_detail, format_point_details
+from charge_point_scrapers.process_pool import BatchedProcessPool
+from charge_point_scrapers.resume import open_resume_index
+from charge_point_scrapers.schemas import BOUNDING_BOX_DECODER, BoundingBoxPoint
+from charge_point_scrapers.sharding import Shard, shard_path
+from charge_point_scrapers.tiling import Tile, TileIndex, top_level_tiles
+from charge_point_scrapers.utils import copy_headers, get_jsonl_feed_path
 
 
 class ZapMapsSpider(scrapy.Spider):
@@ -27,215 +39,564 @@ class ZapMapsSpider(scrapy.Spider):
         'RETRY_TIMES': 3,
         'ITEM_PIPELINES': {
             'charge_point_scrapers.pipelines.ZapMapsPipeline': 100,
+            'charge_point_scrapers.pipelines.ZapMapsStorePipeline': 200,
+            'charge_point_scrapers.pipelines.ZapMapsColumnarOutPipeline': 99998,
             'charge_point_scrapers.pipelines.ZapMapsOutPipeline': 99999,
+        },
+        'DOWNLOADER_MIDDLEWARES': {
+            'charge_point_scrapers.middlewares.DetailResponseCacheMiddleware': 900,
+            'charge_point_scrapers.middlewares.AdaptiveRateMiddleware': 940,
+            # After the cache so cached responses don't wait for a token
+            'charge_point_scrapers.middlewares.ZapMapAuthMiddleware': 950,
+            'charge_point_scrapers.middlewares.ProxyPoolMiddleware': 960,
         }
     }
     auth_headers = {}
     extra_detail_headers = {}
+    extra_detail_policies = ('always', 'never', 'missing_state', 'deferred')
+    # Higher runs first, so points found are fetched before more tiles are opened. The token request is sent by
+    # ZapMapAuthMiddleware outside of the scheduler. Deferred info requests wait until everything else is done
+    request_priorities = {
+        'detail': 30,
+        'next_page': 20,
+        'sub_tile': 10,
+        'top_tile': 0,
+        'deferred_extra_detail': -100,
+    }
+
+    def __init__(self, shard: str = '', merge_shards: str = '', *args, **kwargs):
+        """
+        -a shard=<index>/<count> crawls one shard of the map, see Shard, and -a merge_shards=<count> merges what
+        the shards saved instead of crawling
+        """
+        super().__init__(*args, **kwargs)
+        self.shard = Shard.parse(shard) if shard else None
+        self.merge_shard_count = int(merge_shards or 0)
 
     def start_requests(self):
-        self.scraped_points = {}
+        self.scraped_points = open_resume_index(self, 'uuid')
+        self.logger.info(f"Loaded {len(self.scraped_points)} scraped points")
+        self.delta_mode = self.settings.getbool('ZAP_MAP_DELTA_MODE')
+        self.extra_detail_policy = self.settings.get('ZAP_MAP_EXTRA_DETAIL_POLICY')
+        if self.extra_detail_policy not in self.extra_detail_policies:
+            raise ValueError(
+                f"ZAP_MAP_EXTRA_DETAIL_POLICY must be one of {', '.join(self.extra_detail_policies)}, "
+                f"not {self.extra_detail_policy}"
+            )
+        # Every point listed this crawl, tiles overlap and pages shift so the same point can be listed again
+        self.listed_points = new_id_set(self.settings)
+        self.pending_fingerprints = {}
+        # uuid -> (created_at, legacy_id) of points whose details were requested but not scraped yet
+        self.pending_details = {}
+        self.listing_complete = True
+        self.tombstones_scheduled = False
+        # (legacy_id, formatted_detail, cache_version) of the info requests held back by the deferred policy
+        self.deferred_extra_details = []
+        self.crawler.signals.connect(self.point_scraped, signal=signals.item_scraped)
+        self.crawler.signals.connect(self.spider_idle, signal=signals.spider_idle)
+
         root_dir = Path(__file__).parent.parent.parent
-        feeds = self.settings.get('FEEDS')
-        feed_paths = list(feeds.keys())
-        jsonl_feed_path = None
-        if feed_paths and feeds[feed_paths[0]]['format'] == 'jl':
-            jsonl_feed_path = root_dir / feed_paths[0]
-
-        if jsonl_feed_path and jsonl_feed_path.exists():
-            self.logger.info(f"Found previous feed export at: {jsonl_feed_path}")
-            with open(jsonl_feed_path, 'r', encoding='utf-8') as f:
-                for line in f.readlines():
-                    line_data = json.loads(line)
-                    self.scraped_points[line_data['uuid']] = 1
-
-        self.logger.info(f"Loaded {len(self.scraped_points.keys())} scraped points")
-
-        yield request_zap_auth_token(callback=self.top_level_search)
-
-    def top_level_search(self, response):
-        token = json.loads(response.text)['access_token'].strip()
-        self.auth_headers = copy_headers(
-            ZAP_MAP_REQUEST_HEADERS,
-            {'Authorization': f"Bearer {token}", 'TE': 'trailers'}
+        self.max_tile_depth = self.settings.getint('ZAP_MAP_MAX_TILE_DEPTH')
+        self.tile_pages_pending = Counter()
+        # Tile pages waiting for one of the max_outstanding_tile_requests slots, see queue_tile
+        self.max_outstanding_tile_requests = self.settings.getint('ZAP_MAP_MAX_OUTSTANDING_TILE_REQUESTS')
+        self.outstanding_tile_requests = 0
+        self.tile_backlog = []
+        self.tile_sequence = itertools.count()
+        # (tile, page, pages_requested) -> priority of the tile pages requested but not parsed yet
+        self.in_flight_tile_pages = {}
+        # Failures of each tile page, retried up to ZAP_MAP_TILE_PAGE_RETRIES times and then kept in the frontier
+        self.tile_page_retries = self.settings.getint('ZAP_MAP_TILE_PAGE_RETRIES')
+        self.tile_page_failures = Counter()
+        self.failed_tile_pages = []
+        self.tile_index = TileIndex.load(
+            shard_path(self, root_dir / self.settings.get('ZAP_MAP_TILE_INDEX_FILE')),
+            max_depth=self.max_tile_depth,
+            max_age=self.settings.getint('ZAP_MAP_TILE_INDEX_MAX_AGE_DAYS') * 24 * 60 * 60
         )
+        self.logger.info(f"Loaded {len(self.tile_index.tiles)} tiles from the tile index")
+        if self.merge_shard_count:
+            self.merge_shards(root_dir)
+            return
+
+        # The bearer token is added by ZapMapAuthMiddleware to requests with zap_auth meta
+        self.auth_headers = copy_headers(ZAP_MAP_REQUEST_HEADERS, {'TE': 'trailers'})
         self.extra_detail_headers = copy_headers(
             ZAP_MAP_REQUEST_HEADERS,
             ZAP_MAP_V5_POINT_INFO_HEADERS
         )
-        for latitude in range(SOUTHERN_MOST_LATITUDE_UK, NORTHERN_MOST_LATITUDE_UK + 1):
-            for longitude in range(WESTERN_MOST_LONGITUDE_UK, EASTERN_MOST_LONGITUDE_UK + 1):
-                lat_cor, long_cor = f'{latitude}.0', f'{longitude}.0'
-                yield Request(
-                    BOUNDING_BOX_FILTER_URL.format(latitude=lat_cor, longitude=long_cor, page=1),
-                    headers=self.auth_headers,
-                    callback=self.top_level_boundary_search,
-                    cb_kwargs={'latitude': lat_cor, 'longitude': long_cor},
-                    dont_filter=True
-                )
+        # Detail and info responses are turned into items by the normalisation functions, in worker processes when
+        # NORMALISATION_PROCESSES is set so decoding large payloads doesn't hold up the reactor
+        self.normalisation_pool = BatchedProcessPool(
+            self.settings.getint('NORMALISATION_PROCESSES'),
+            batch_size=self.settings.getint('NORMALISATION_BATCH_SIZE'),
+            max_delay=self.settings.getfloat('NORMALISATION_MAX_DELAY')
+        )
 
-    def top_level_boundary_search(
-            self,
-            response: Response,
-            latitude: str,
-            longitude: str
-    ):
-        """
-        Extract page_data from top level filters which is upto 250 total records per lat:long pair
-        If next page exists(current_page < last_page) then follow the next page upto the end, yielding each point found
-        in results
-
-        If total top level count > 250 then proceed to do a lower level filter using the same strat above.
-        :return:
-        """
-        json_res = json.loads(response.text)
-        page_data = json_res['data']
-        top_lvl_total = json_res['meta']['total']
-        last_page = json_res['meta']['last_page']
-        current_page = json_res['meta']['current_page']
-
-        if top_lvl_total <= 250:
-            for point in page_data:
-                if point['uuid'] not in self.scraped_points:
-                    yield Request(
-                        CHARGE_POINT_DETAILS_ENDPOINT.format(uuid=point['uuid']),
-                        headers=self.auth_headers,
-                        callback=self.parse_charge_point_details,
-                        cb_kwargs={'date_created': point['created_at'], 'legacy_id': point['legacy_id']}
-                    )
-
-            if current_page < last_page:
-                yield Request(
-                    BOUNDING_BOX_FILTER_URL.format(latitude=latitude, longitude=longitude, page=current_page+1),
-                    headers=self.auth_headers,
-                    callback=self.top_level_boundary_search,
-                    cb_kwargs={'latitude': latitude, 'longitude': longitude}
-                )
+        job_dir = self.settings.get('JOBDIR')
+        self.frontier_path = shard_path(
+            self, (Path(job_dir) if job_dir else root_dir) / self.settings.get('ZAP_MAP_FRONTIER_FILE')
+        )
+        frontier = self.load_frontier()
+        # Top level tiles this crawl started from, for the requests_saved stat. Unknown for resumed crawls
+        self.crawl_start_tiles = None
+        self.frontier_checkpoint = task.LoopingCall(self.save_frontier)
+        self.frontier_checkpoint.start(self.settings.getint('ZAP_MAP_FRONTIER_CHECKPOINT_INTERVAL'), now=False)
+        if frontier:
+            yield from self.restore_frontier(frontier)
+        else:
+            start_tiles = list(self.start_tiles())
+            self.crawl_start_tiles = start_tiles
+            # Dense top level tiles split up front by the tile index count as splits too
+            self.crawler.stats.inc_value(
+                'zap_maps/tiles/split/depth_0', sum(1 for tile in start_tiles if self.tile_index.is_split(tile))
+            )
+            self.queue_tiles(self.tile_index.plan(start_tiles), planned=True)
+        yield from self.release_tile_requests()
+
+    def start_tiles(self):
+        """The top level tiles, only those of the spider's shard when it's one shard of the crawl"""
+        if not self.shard:
+            return top_level_tiles()
+        self.logger.info(f"Crawling shard {self.shard.index} of {self.shard.count}")
+        return (tile for tile in top_level_tiles() if self.shard.owns(tile))
+
+    def merge_shards(self, root_dir: Path):
+        """
+        Merge the stores, resume indexes and tile indexes saved by the merge_shards shards of a sharded crawl,
+        copied into this project from wherever they ran, into the unsharded ones. The exports then write the
+        merged points when the spider closes. The ids are merged into the resume index of the -o feed the regular
+        crawls are run with, see open_resume_index
+        """
+        stats = self.crawler.stats
+        if not get_jsonl_feed_path(self.settings):
+            self.logger.warning(
+                f"Merging the scraped ids into {self.scraped_points.path}, crawls run with a json lines feed won't "
+                f"see them. Pass the feed they're run with, e.g. -o {self.name}.jl"
+            )
+        store_path = root_dir / self.settings.get('CHARGE_POINT_STORE_FILE')
+        for index in range(self.merge_shard_count):
+            shard = Shard(index, self.merge_shard_count)
+            if not shard.path(store_path).exists():
+                self.logger.warning(f"Shard {index} of {shard.count} not found at {shard.path(store_path)}")
+                continue
+            points = self.store.merge(shard.path(store_path))
+            ids = 0
+            if shard.path(root_dir / f'{self.name}.idx').exists():
+                ids = self.scraped_points.merge(shard.path(root_dir / f'{self.name}.idx'))
+            if shard.path(self.tile_index.path).exists():
+                self.tile_index.merge(TileIndex.load(shard.path(self.tile_index.path), self.max_tile_depth))
+            stats.inc_value('shards/merged')
+            stats.inc_value('shards/points_merged', points)
+            self.logger.info(f"Merged shard {index} of {shard.count}: {points} points, {ids} new scraped ids")
+        self.tile_index.compact()
+        self.tile_index.save()
+
+    def load_frontier(self):
+        if not self.settings.getbool('ZAP_MAP_RESUME_FRONTIER'):
+            return None
+        frontier = Frontier.load(self.frontier_path)
+        if frontier and frontier.age > self.settings.getint('ZAP_MAP_FRONTIER_MAX_AGE_HOURS') * 60 * 60:
+            self.logger.info(f"Ignoring the frontier saved {frontier.age // 3600} hours ago at {self.frontier_path}")
+            return None
+        return frontier
+
+    def restore_frontier(self, frontier: Frontier):
+        """
+        Pick up an interrupted crawl where its last checkpoint left off instead of walking every tile again.
+        Details of points scraped since the checkpoint are skipped, the token is fetched again by
+        ZapMapAuthMiddleware. Tile pages and details that were in flight are requested again. With JOBDIR the
+        scheduler restores the requests it still held as well, those copies are dropped by boundary_search and
+        parse_charge_point_details once the frontier's own request is tracked or done.
+        """
+        self.listed_points = frontier.listed_points
+        self.listing_complete = frontier.listing_complete
+        for tile_page in [*frontier.tile_pages, *frontier.in_flight_tile_pages]:
+            self.queue_tile(tile_page.tile, tile_page.priority, tile_page.page, tile_page.pages_requested)
+
+        details_restored = 0
+        for detail in frontier.details:
+            if detail.uuid in self.scraped_points and (
+                    not self.delta_mode or self.scraped_points.get_fingerprint(detail.uuid) == detail.fingerprint
+            ):
+                continue
+            self.pending_fingerprints[detail.uuid] = detail.fingerprint
+            self.pending_details[detail.uuid] = (detail.created_at, detail.legacy_id)
+            details_restored += 1
+            yield self.detail_request(detail.uuid, detail.created_at, detail.legacy_id)
+
+        stats = self.crawler.stats
+        stats.set_value('zap_maps/frontier/restored_tile_pages', len(self.tile_backlog))
+        stats.set_value('zap_maps/frontier/restored_details', details_restored)
+        self.logger.info(
+            f"Resuming from the frontier saved {frontier.age}s ago: {len(self.tile_backlog)} tile pages, "
+            f"{len(self.pending_details)} points to scrape, {len(self.listed_points)} points already listed"
+        )
+
+    def save_frontier(self):
+        """
+        Checkpoint the frontier every ZAP_MAP_FRONTIER_CHECKPOINT_INTERVAL seconds. Scraped ids and stored items are
+        committed first, so every point left out of the checkpoint's details is safely on disk
+        """
+        self.scraped_points.commit()
+        store = getattr(self, 'store', None)
+        if store:
+            store.flush()
+        self.tile_index.save()
+        Frontier(
+            tile_pages=[
+                *(TilePage(tile, page, pages_requested, -negative_priority)
+                  for negative_priority, _, tile, page, pages_requested in self.tile_backlog),
+                *self.failed_tile_pages
+            ],
+            in_flight_tile_pages=[TilePage(*key, priority) for key, priority in self.in_flight_tile_pages.items()],
+            details=[
+                PendingDetail(uuid, created_at, legacy_id, self.pending_fingerprints.get(uuid, ''))
+                for uuid, (created_at, legacy_id) in self.pending_details.items()
+            ],
+            listed_points=self.listed_points,
+            listing_complete=self.listing_complete,
+            saved_at=int(time.time())
+        ).save(self.frontier_path)
+        self.crawler.stats.inc_value('zap_maps/frontier/checkpoints')
+
+    def queue_tiles(self, tiles, planned: bool = False):
+        """
+        Queue the first page of each tile, skipping tiles that are entirely sea or outside GB.
+        Planned tiles with a last_page known from the tile index have all of their pages queued at once.
+        """
+        stats = self.crawler.stats
+        for tile in tiles:
+            if not tile.is_on_land():
+                stats.inc_value('zap_maps/tiles/skipped_offshore')
+                continue
+            stats.inc_value('zap_maps/tiles/requested')
+            stats.inc_value(f'zap_maps/tiles/requested/depth_{tile.depth}')
+            priority = self.request_priorities['sub_tile' if tile.depth else 'top_tile']
+            known_last_page = self.tile_index.known_last_page(tile) if planned else None
+            if known_last_page:
+                stats.inc_value('zap_maps/tile_index/planned_tiles')
+                stats.inc_value('zap_maps/tile_index/planned_pages', known_last_page)
+                for page in range(1, known_last_page + 1):
+                    self.queue_tile(tile, priority, page=page, pages_requested=known_last_page)
+            else:
+                self.queue_tile(tile, priority)
+
+    def queue_tile(self, tile: Tile, priority: int, page: int = 1, pages_requested: int = 1):
+        """
+        Tile pages are requested through release_tile_requests, at most ZAP_MAP_MAX_OUTSTANDING_TILE_REQUESTS
+        at a time, rather than all being handed to the scheduler as soon as they're found.
+        """
+        self.tile_pages_pending[tile] += 1
+        heapq.heappush(self.tile_backlog, (-priority, next(self.tile_sequence), tile, page, pages_requested))
+        self.crawler.stats.max_value('zap_maps/tiles/max_backlog', len(self.tile_backlog))
+
+    def release_tile_requests(self):
+        """Request the highest priority queued tile pages while there are free slots"""
+        while self.tile_backlog and self.outstanding_tile_requests < self.max_outstanding_tile_requests:
+            negative_priority, _, tile, page, pages_requested = heapq.heappop(self.tile_backlog)
+            self.outstanding_tile_requests += 1
+            self.in_flight_tile_pages[(tile, page, pages_requested)] = -negative_priority
+            yield self.tile_request(tile, -negative_priority, page=page, pages_requested=pages_requested)
+
+    def tile_request(self, tile: Tile, priority: int, page: int = 1, pages_requested: int = 1):
+        latitude, longitude = tile.query_coordinates
+        return Request(
+            BOUNDING_BOX_FILTER_URL.format(latitude=latitude, longitude=longitude, page=page),
+            headers=self.auth_headers,
+            callback=self.boundary_search,
+            errback=self.tile_failed,
+            cb_kwargs={'tile': tile, 'page': page, 'pages_requested': pages_requested},
+            meta={'zap_auth': True},
+            priority=priority,
+            dont_filter=True
+        )
+
+    def tile_failed(self, failure):
+        """
+        Failed tile pages are queued again up to ZAP_MAP_TILE_PAGE_RETRIES times. After that the tile stays pending
+        so the listing counts as incomplete, and the page is kept in the frontier for the next crawl to retry
+        """
+        cb_kwargs = failure.request.cb_kwargs
+        key = (cb_kwargs['tile'], cb_kwargs['page'], cb_kwargs['pages_requested'])
+        priority = self.in_flight_tile_pages.pop(key, None)
+        if priority is None:
+            # A copy of a restored tile page, see restore_frontier
+            return
+        self.outstanding_tile_requests -= 1
+        stats = self.crawler.stats
+        self.tile_page_failures[key] += 1
+        if self.tile_page_failures[key] <= self.tile_page_retries:
+            stats.inc_value('zap_maps/tiles/retried_pages')
+            self.logger.warning(
+                f"Tile page {failure.request.url} failed, retry {self.tile_page_failures[key]} of "
+                f"{self.tile_page_retries}: {failure.getErrorMessage()}"
+            )
+            # Still counted as pending from its first attempt
+            self.tile_pages_pending[key[0]] -= 1
+            self.queue_tile(key[0], priority, page=key[1], pages_requested=key[2])
         else:
-            for i in range(0, 10):
-                int_lat, int_long = int(float(latitude)), int(float(longitude))
-                low_lvl_lat = f'{int_lat}.{i}0'
-                neg_adjusted_long = int_long
-                if int_long < 0:
-                    if int_long == -1:
-                        # At -1, longitude filter results will be from -1.00 to -0.90 with -1.0 being exclusive
-                        # Since we can't sign the int 0 set neg_adjusted as a string -0
-                        neg_adjusted_long = '-0'
-                    else:
-                        neg_adjusted_long += 1
-
-                    yield Request(
-                        BOUNDING_BOX_FILTER_URL.format(latitude=low_lvl_lat, longitude=f'{int_long}.00', page=1),
-                        headers=self.auth_headers,
-                        callback=self.low_level_boundary_search,
-                        cb_kwargs={'latitude': low_lvl_lat, 'longitude': f'{int_long}.00'},
-                        dont_filter=True
-                    )
-
-                for j in range(1, 10):
-                    low_lvl_long = f'{neg_adjusted_long}.{j}0'
-                    yield Request(
-                        BOUNDING_BOX_FILTER_URL.format(latitude=low_lvl_lat, longitude=low_lvl_long, page=1),
-                        headers=self.auth_headers,
-                        callback=self.low_level_boundary_search,
-                        cb_kwargs={'latitude': low_lvl_lat, 'longitude': low_lvl_long},
-                        dont_filter=True
-                    )
-
-    def low_level_boundary_search(
-            self,
-            response: Response,
-            latitude: str,
-            longitude: str,
-    ):
-        """
-        Low level filter/search if top level count > 250.
-        Uses same strategy as search_latitude_boundary to filter down pages.
-        """
-        json_res = json.loads(response.text)
-        page_data = json_res['data']
-        last_page = json_res['meta']['last_page']
-        current_page = json_res['meta']['current_page']
-        if page_data:
-            for point in page_data:
-                if point['uuid'] not in self.scraped_points:
-                    yield Request(
-                        CHARGE_POINT_DETAILS_ENDPOINT.format(uuid=point['uuid']),
-                        headers=self.auth_headers,
-                        callback=self.parse_charge_point_details,
-                        cb_kwargs={'date_created': point['created_at'], 'legacy_id': point['legacy_id']}
-                    )
-
-            if current_page < last_page:
-                yield Request(
-                    BOUNDING_BOX_FILTER_URL.format(latitude=latitude, longitude=longitude, page=current_page+1),
-                    headers=self.auth_headers,
-                    callback=self.low_level_boundary_search,
-                    cb_kwargs={'latitude': latitude, 'longitude': longitude},
-                    dont_filter=True
+            stats.inc_value('zap_maps/tiles/failed_pages')
+            self.failed_tile_pages.append(TilePage(*key, priority))
+            self.logger.error(f"Tile page {failure.request.url} failed: {failure.getErrorMessage()}")
+        yield from self.release_tile_requests()
+
+    def boundary_search(self, response: Response, tile: Tile, page: int = 1, pages_requested: int = 1):
+        """
+        Extract page_data from a lat:long tile. The search only returns upto BOUNDING_BOX_RESULTS_CAP records
+        per tile so while a tile's total is over the cap it is split into its 10x10 sub tiles and searched again,
+        down to ZAP_MAP_MAX_TILE_DEPTH.
+        Otherwise once the first page returns meta.last_page every remaining page of the tile is requested at once,
+        yielding each point found in results.
+
+        pages_requested is how many pages of the tile were requested up front, from the tile index or the fan out.
+        If a planned tile has drifted over the cap it is split again, if it has grown more pages the missing ones
+        are requested.
+        """
+        if self.in_flight_tile_pages.pop((tile, page, pages_requested), None) is None:
+            # A copy of a restored tile page, see restore_frontier
+            self.crawler.stats.inc_value('zap_maps/frontier/duplicate_tile_pages')
+            return
+        self.outstanding_tile_requests -= 1
+        search_results = BOUNDING_BOX_DECODER.decode(response.body)
+        page_data = search_results.data
+        total = search_results.meta.total
+        last_page = search_results.meta.last_page
+        current_page = search_results.meta.current_page
+        self.log_tile_page(tile, current_page, last_page, len(page_data))
+
+        if current_page == 1:
+            previous_record = self.tile_index.tiles.get(tile)
+            self.tile_index.record(tile, total, last_page)
+            if total > BOUNDING_BOX_RESULTS_CAP:
+                if tile.depth < self.max_tile_depth:
+                    self.crawler.stats.inc_value('zap_maps/tiles/split')
+                    if tile.depth == 0:
+                        self.crawler.stats.inc_value('zap_maps/tiles/split/depth_0')
+                    if previous_record and previous_record.total <= BOUNDING_BOX_RESULTS_CAP:
+                        self.crawler.stats.inc_value('zap_maps/tile_index/drift_split')
+                    self.queue_tiles(tile.children())
+                    yield from self.release_tile_requests()
+                    return
+                self.listing_complete = False
+                self.logger.warning(
+                    f"Tile {tile} has {total} points at max depth {self.max_tile_depth}, "
+                    f"only the first {BOUNDING_BOX_RESULTS_CAP} can be scraped"
                 )
 
-    def parse_charge_point_details(self, response: Response, date_created: str, legacy_id: int):
-        details = json.loads(response.text)['data']
-        if details['country'].upper() == 'GB':
-            city = details['city'] or ''
-            state = details['state'] or ''
-            street_address = details['address'] or ''
-            postal_code = details['postal_code'] or ''
-            address = " ".join([field for field in [street_address, city, state, postal_code] if field])
-            parking_fee = details['parking'].get('fee') or ''
-            charging_fee = ''
-            devices = details['devices']
-            if len(devices) > 0:
-                charging_fee = devices[0]['payment_details']['pricing']
-            operator_name = details['operator']['name'] or ''
-            phone_number = details['owner']['telephone_number'] or ''
-
-            formatted_detail = {
-                'legacy_id': legacy_id,
-                'uuid': details['uuid'],
-                'name': details['name'],
-                'city': city,
-                'state': state,
-                'street_address': street_address,
-                'postal_code': postal_code,
-                'full_address': address,
-                'phone_number': phone_number,
-                'date_created': parse_date(date_created),
-                'date_updated': parse_date(details['updated_at']),
-                'parking_fee': parking_fee,
-                'charging_fee': charging_fee,
-                'operator_name': operator_name,
-                'location_url': f"https://www.zap-map.com/charge-points/{details['uuid']}/"
-            }
-            yield Request(
-                CHARGE_POINT_EXTRA_DETAILS_ENDPOINT.format(legacy_id=legacy_id),
-                callback=self.parse_charge_point_extra_detail,
-                headers=self.extra_detail_headers,
-                cb_kwargs={'formatted_detail': formatted_detail}
+        for point in page_data:
+            if self.should_scrape_point(point):
+                self.pending_details[point.uuid] = (point.created_at, point.legacy_id)
+                yield self.detail_request(point.uuid, point.created_at, point.legacy_id)
+
+        if current_page == 1 and last_page > pages_requested:
+            if pages_requested > 1:
+                self.crawler.stats.inc_value('zap_maps/tile_index/drift_pages', last_page - pages_requested)
+            self.crawler.stats.inc_value('zap_maps/tiles/fanned_out_pages', last_page - pages_requested)
+            for page in range(pages_requested + 1, last_page + 1):
+                self.queue_tile(tile, self.request_priorities['next_page'], page=page, pages_requested=last_page)
+        yield from self.release_tile_requests()
+
+    def detail_request(self, uuid: str, created_at: Optional[str], legacy_id: int):
+        return Request(
+            CHARGE_POINT_DETAILS_ENDPOINT.format(uuid=uuid),
+            headers=self.auth_headers,
+            callback=self.parse_charge_point_details,
+            cb_kwargs={'uuid': uuid, 'date_created': created_at, 'legacy_id': legacy_id},
+            meta={'zap_auth': True, 'cache_version': self.pending_fingerprints[uuid]},
+            priority=self.request_priorities['detail']
+        )
+
+    def log_tile_page(self, tile: Tile, current_page: int, last_page: int, points_count: int):
+        """Pages of a tile arrive in any order, keep track of each tile until all of its pages are in"""
+        self.crawler.stats.inc_value('zap_maps/tiles/pages_parsed')
+        self.logger.debug(f"Tile {tile} page {current_page}/{last_page}: {points_count} points")
+        self.tile_pages_pending[tile] -= 1
+        if self.tile_pages_pending[tile] <= 0:
+            del self.tile_pages_pending[tile]
+            self.crawler.stats.inc_value('zap_maps/tiles/completed')
+            self.logger.debug(f"Tile {tile} complete, {last_page} pages")
+
+    def should_scrape_point(self, point: BoundingBoxPoint) -> bool:
+        """
+        Points already listed in this crawl or already scraped are skipped. In delta mode scraped points are
+        compared against the fingerprint of their listing fields instead and only points that changed since they
+        were scraped are fetched again.
+        """
+        uuid = point.uuid
+        stats = self.crawler.stats
+        if not self.listed_points.add(uuid):
+            stats.inc_value('zap_maps/details/duplicates_skipped')
+            return False
+
+        fingerprint = f"{point.created_at or ''}|{point.updated_at or ''}"
+        if not self.delta_mode:
+            if uuid in self.scraped_points:
+                return False
+            self.pending_fingerprints[uuid] = fingerprint
+            return True
+
+        stored_fingerprint = self.scraped_points.get_fingerprint(uuid)
+        if stored_fingerprint is None:
+            stats.inc_value('zap_maps/delta/new')
+        elif not stored_fingerprint:
+            # Scraped before fingerprints were kept, take the current listing as the baseline
+            self.scraped_points.set_fingerprint(uuid, fingerprint)
+            stats.inc_value('zap_maps/delta/unchanged')
+            return False
+        elif stored_fingerprint == fingerprint:
+            stats.inc_value('zap_maps/delta/unchanged')
+            return False
+        else:
+            stats.inc_value('zap_maps/delta/changed')
+
+        self.pending_fingerprints[uuid] = fingerprint
+        return True
+
+    def point_scraped(self, item):
+        self.pending_details.pop(item['uuid'], None)
+        fingerprint = self.pending_fingerprints.pop(item['uuid'], None)
+        if fingerprint:
+            self.scraped_points.set_fingerprint(item['uuid'], fingerprint)
+
+    def spider_idle(self):
+        """
+        Once the listing and details are done, the info requests held back by the deferred extra detail policy
+        are sent. Then delta crawls emit a tombstone for every scraped point that wasn't listed again.
+        Skipped if any tile page failed or was truncated since missing points may not have been removed.
+        """
+        if self.merge_shard_count:
+            return
+        if self.tile_backlog:
+            # Only happens if a tile callback raised before releasing more tile requests. Nothing is in flight
+            self.outstanding_tile_requests = 0
+            for request in self.release_tile_requests():
+                self.crawler.engine.crawl(request)
+            raise DontCloseSpider
+
+        if self.deferred_extra_details:
+            # Listing and details are done, send the info requests held back by the deferred policy
+            self.logger.info(f"Requesting {len(self.deferred_extra_details)} deferred extra details")
+            for legacy_id, formatted_detail, cache_version in self.deferred_extra_details:
+                self.crawler.engine.crawl(self.extra_detail_request(legacy_id, formatted_detail, cache_version, True))
+            self.deferred_extra_details = []
+            raise DontCloseSpider
+
+        if not self.delta_mode or self.tombstones_scheduled:
+            return
+        self.tombstones_scheduled = True
+        if self.tile_pages_pending or not self.listing_complete:
+            self.logger.warning("Listing incomplete, skipping tombstones for removed points")
+            return
+
+        self.crawler.engine.crawl(Request('data:,', callback=self.emit_tombstones, dont_filter=True))
+        raise DontCloseSpider
+
+    def emit_tombstones(self, response):
+        removed_points = [uuid for uuid in self.scraped_points if uuid not in self.listed_points]
+        self.logger.info(f"Found {len(removed_points)} removed points")
+        for uuid in removed_points:
+            self.crawler.stats.inc_value('zap_maps/delta/tombstones')
+            yield {'uuid': uuid, 'deleted': True, 'date_updated': datetime.date.today().isoformat()}
+
+    async def parse_charge_point_details(self, response: Response, uuid: str, date_created: str, legacy_id: int):
+        if uuid not in self.pending_details:
+            # A copy of a restored detail request, see restore_frontier
+            self.crawler.stats.inc_value('zap_maps/frontier/duplicate_details')
+            return
+        formatted_detail = await maybe_deferred_to_future(
+            self.normalisation_pool.submit(format_point_details, response.body, date_created, legacy_id)
+        )
+        if formatted_detail is None:
+            # Outside GB
+            self.pending_details.pop(uuid, None)
+            self.pending_fingerprints.pop(uuid, None)
+            return
+        for output in self.request_extra_detail(response, legacy_id, formatted_detail):
+            yield output
+
+    def request_extra_detail(self, response: Response, legacy_id: int, formatted_detail: dict):
+        """
+        The info endpoint only refines the county and location URL, so depending on ZAP_MAP_EXTRA_DETAIL_POLICY
+        it's requested for every point, never, only for points without a county, or deferred: the point is
+        emitted straight away, the info request is held back until every tile and detail has been crawled, see
+        spider_idle, and the point is emitted again if it found a different address.
+        """
+        stats = self.crawler.stats
+        policy = self.extra_detail_policy
+        if policy == 'never' or (policy == 'missing_state' and formatted_detail['state']):
+            stats.inc_value('zap_maps/extra_details/skipped')
+            yield formatted_detail
+            return
+
+        if policy == 'deferred':
+            stats.inc_value('zap_maps/extra_details/deferred')
+            self.deferred_extra_details.append((legacy_id, dict(formatted_detail), response.meta.get('cache_version')))
+            yield formatted_detail
+            return
+        yield self.extra_detail_request(legacy_id, formatted_detail, response.meta.get('cache_version'))
+
+    def extra_detail_request(self, legacy_id: int, formatted_detail: dict, cache_version, deferred: bool = False):
+        return Request(
+            CHARGE_POINT_EXTRA_DETAILS_ENDPOINT.format(legacy_id=legacy_id),
+            callback=self.parse_charge_point_extra_detail,
+            headers=self.extra_detail_headers,
+            cb_kwargs={'formatted_detail': dict(formatted_detail), 'deferred': deferred},
+            meta={'cache_version': cache_version},
+            priority=self.request_priorities['deferred_extra_detail' if deferred else 'detail']
+        )
+
+    async def parse_charge_point_extra_detail(self, response, formatted_detail, deferred: bool = False):
+        original_detail = formatted_detail
+        formatted_detail = await maybe_deferred_to_future(
+            self.normalisation_pool.submit(apply_extra_detail, response.body, formatted_detail)
+        )
+
+        if not deferred:
+            yield formatted_detail
+        elif formatted_detail != original_detail:
+            self.crawler.stats.inc_value('zap_maps/extra_details/patched')
+            formatted_detail['extra_detail_patch'] = True
+            yield formatted_detail
+
+    def closed(self, reason):
+        if self.merge_shard_count:
+            return
+        if self.frontier_checkpoint.running:
+            self.frontier_checkpoint.stop()
+        if reason == 'finished' and not self.failed_tile_pages:
+            Frontier.clear(self.frontier_path)
+        else:
+            self.save_frontier()
+            self.logger.info(
+                f"Crawl {reason} with {len(self.failed_tile_pages)} failed tile pages, saved the frontier to "
+                f"{self.frontier_path} to resume from"
             )
 
-    def parse_charge_point_extra_detail(self, response, formatted_detail):
-        parsed_response = json.loads(response.text)
-
-        if parsed_response:
-            full_detail_address = None
-            extra_details = parsed_response['resources']['chargepoint_location_info']['data']['details']
-            for detail in extra_details:
-                marker_id = detail.get('marker', {}).get('id', 0)
-                if marker_id == FULL_ADDRESS_MARKER:
-                    full_detail_address = detail['description'].strip()
-                elif marker_id == LOCATION_URL_MARKER:
-                    formatted_detail['location_url'] = detail.get('link', {}).get('value', '').strip()
-
-            if full_detail_address:
-                addr_parts = full_detail_address.split('\r\n')
-                formatted_detail['state'] = addr_parts[-2]
-                formatted_detail['full_address'] = " ".join([field for field in [
-                    formatted_detail['street_address'],
-                    formatted_detail['city'],
-                    formatted_detail['state'],
-                    formatted_detail['postal_code']
-                ] if field])
-
-        yield formatted_detail
+        # The fixed grid's pages for the totals this crawl saw, counted before compacting drops sub tile records
+        fixed_grid_pages = None
+        if self.crawl_start_tiles is not None:
+            fixed_grid_pages = sum(self.tile_index.fixed_grid_pages(tile) for tile in self.crawl_start_tiles)
+        self.tile_index.compact()
+        self.tile_index.save()
+        self.logger.info(f"Saved {len(self.tile_index.tiles)} tiles to the tile index")
+
+        stats = self.crawler.stats
+        requested = stats.get_value('zap_maps/tiles/requested', 0)
+        self.logger.info(
+            f"Adaptive tiling requested {requested} tiles, skipped "
+            f"{stats.get_value('zap_maps/tiles/skipped_offshore', 0)} offshore tiles"
+        )
+        if fixed_grid_pages is not None:
+            # Negative when 0.1 degree tiles over the cap had to be split, listing points the fixed grid missed
+            requests_saved = fixed_grid_pages - stats.get_value('zap_maps/tiles/pages_parsed', 0)
+            stats.set_value('zap_maps/tiles/requests_saved', requests_saved)
+            self.logger.info(f"Tile page requests saved compared with the fixed grid: {requests_saved}")
+
+        record_id_set_stats(stats, 'dedup/listed', self.listed_points)
+        self.normalisation_pool.record_stats(stats, 'normalisation')
+        self.normalisation_pool.close()
+        self.logger.info(
+            f"Skipped {stats.get_value('zap_maps/details/duplicates_skipped', 0)} detail requests "
+            f"for points listed more than once"
+        )
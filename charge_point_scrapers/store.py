@@ -0,0 +1,141 @@
+import json
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
+
+
+class ChargePointStore:
+    """
+    Canonical store of a spider's items, one row per key_field holding the latest version of the item.
+    Re-scraped items replace the stored ones and tombstones ({key_field: ..., "deleted": true}) mark them deleted,
+    so the store never grows past the number of points.
+    Items are written in batches of batch_size, each in one transaction. indexed_fields are copied into their own
+    columns and indexed so exports can query them instead of scanning every item, e.g.
+    {'post_code': 'TEXT', 'latitude': 'REAL'} with indexes [('post_code',), ('latitude', 'longitude')]
+    """
+
+    def __init__(
+            self,
+            path: Union[Path, str],
+            table: str,
+            key_field: str,
+            indexed_fields: Dict[str, str],
+            indexes: List[Tuple[str, ...]],
+            batch_size: int = 1000
+    ):
+        self.table = table
+        self.key_field = key_field
+        self.indexed_fields = indexed_fields
+        self.batch_size = batch_size
+        self.pending = []
+        self.pending_deletes = []
+        self.conn = sqlite3.connect(str(path))
+        self.conn.execute('PRAGMA journal_mode=WAL')
+
+        columns = ''.join(f', {field} {column_type}' for field, column_type in indexed_fields.items())
+        self.conn.execute(
+            f'CREATE TABLE IF NOT EXISTS {table} '
+            f'(key TEXT PRIMARY KEY, deleted INTEGER NOT NULL DEFAULT 0, scraped_at INTEGER, item TEXT{columns})'
+        )
+        existing_columns = [row[1] for row in self.conn.execute(f'PRAGMA table_info({table})')]
+        for field, column_type in indexed_fields.items():
+            if field not in existing_columns:
+                self.conn.execute(f'ALTER TABLE {table} ADD COLUMN {field} {column_type}')
+        for fields in indexes:
+            self.conn.execute(
+                f'CREATE INDEX IF NOT EXISTS {table}_{"_".join(fields)} ON {table} ({", ".join(fields)})'
+            )
+        self.conn.commit()
+
+        self.fields = ['key', 'deleted', 'scraped_at', 'item', *indexed_fields]
+        self.update_clause = ', '.join(f'{field} = excluded.{field}' for field in self.fields[1:])
+        self.upsert_sql = (
+            f'INSERT INTO {table} ({", ".join(self.fields)}) VALUES ({", ".join("?" * len(self.fields))}) '
+            f'ON CONFLICT(key) DO UPDATE SET {self.update_clause}'
+        )
+
+    def __len__(self) -> int:
+        self.flush()
+        return self.conn.execute(f'SELECT COUNT(*) FROM {self.table} WHERE NOT deleted').fetchone()[0]
+
+    def column_value(self, field: str, val):
+        if val in ('', None):
+            return None
+        if self.indexed_fields[field] == 'REAL':
+            try:
+                return float(val)
+            except (TypeError, ValueError):
+                return None
+        return str(val)
+
+    def put(self, item: dict):
+        if item.get('deleted'):
+            # Keep the last known version of deleted items
+            self.pending_deletes.append((int(time.time()), str(item[self.key_field])))
+        else:
+            self.pending.append((
+                str(item[self.key_field]),
+                0,
+                int(time.time()),
+                json.dumps(item, ensure_ascii=False),
+                *(self.column_value(field, item.get(field)) for field in self.indexed_fields)
+            ))
+        if len(self.pending) + len(self.pending_deletes) >= self.batch_size:
+            self.flush()
+
+    def put_many(self, items: Iterable[dict]):
+        for item in items:
+            self.put(item)
+        self.flush()
+
+    def flush(self):
+        if not self.pending and not self.pending_deletes:
+            return
+        with self.conn:
+            self.conn.executemany(self.upsert_sql, self.pending)
+            self.conn.executemany(
+                f'UPDATE {self.table} SET deleted = 1, scraped_at = ? WHERE key = ?', self.pending_deletes
+            )
+        self.pending, self.pending_deletes = [], []
+
+    def merge(self, path: Union[Path, str]) -> int:
+        """
+        Upsert the rows of the same table in another store, e.g. a shard's, keeping whichever version of each item
+        was scraped last. Returns the number of rows merged
+        """
+        self.flush()
+        fields = ', '.join(self.fields)
+        self.conn.execute('ATTACH DATABASE ? AS other', (str(path),))
+        try:
+            with self.conn:
+                # WHERE true tells the parser the ON CONFLICT belongs to the INSERT
+                cursor = self.conn.execute(
+                    f'INSERT INTO main.{self.table} ({fields}) SELECT {fields} FROM other.{self.table} WHERE true '
+                    f'ON CONFLICT(key) DO UPDATE SET {self.update_clause} '
+                    f'WHERE excluded.scraped_at >= {self.table}.scraped_at'
+                )
+            return cursor.rowcount
+        finally:
+            self.conn.execute('DETACH DATABASE other')
+
+    def items(self, where: str = '', params: tuple = ()) -> Iterator[dict]:
+        """Items that aren't deleted, in the order they were first stored. where is an extra SQL condition"""
+        self.flush()
+        condition = f'NOT deleted AND ({where})' if where else 'NOT deleted'
+        cursor = self.conn.execute(f'SELECT item FROM {self.table} WHERE {condition} ORDER BY rowid', params)
+        return (json.loads(row[0]) for row in cursor)
+
+    def items_within_boxes(self, boxes: Iterable[Tuple[float, float, float, float]]) -> Iterator[dict]:
+        """Items whose latitude and longitude fall within any of the (min_lat, min_long, max_lat, max_long) boxes"""
+        boxes = list(boxes)
+        if not boxes:
+            return iter(())
+        where = ' OR '.join(['(latitude BETWEEN ? AND ? AND longitude BETWEEN ? AND ?)'] * len(boxes))
+        params = tuple(val for min_lat, min_long, max_lat, max_long in boxes
+                       for val in (min_lat, max_lat, min_long, max_long))
+        return self.items(where, params)
+
+    def close(self):
+        self.flush()
+        self.conn.close()
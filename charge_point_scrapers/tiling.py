@@ -0,0 +1,198 @@
+import json
+import time
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, NamedTuple, Optional, Tuple, Union
+
+from charge_point_scrapers.constants import (
+    BOUNDING_BOX_RESULTS_CAP,
+    WESTERN_MOST_LONGITUDE_UK,
+    EASTERN_MOST_LONGITUDE_UK,
+    NORTHERN_MOST_LATITUDE_UK,
+    SOUTHERN_MOST_LATITUDE_UK,
+    GB_LAND_BOUNDING_BOXES
+)
+
+# Each subdivision splits a tile into a 10x10 grid since the bounding box search only understands decimal cells
+TILE_FAN_OUT = 10
+
+
+def format_coordinate(value: int, depth: int) -> str:
+    """
+    Format a tile edge as expected by the bounding box search.
+    The number of decimal places selects the cell size, one more than the tile depth with a trailing 0:
+        depth 0 -> 49.0 (1 degree), depth 1 -> 49.10 (0.1 degrees), depth 2 -> 49.120 (0.01 degrees)
+    """
+    if depth == 0:
+        return f'{value}.0'
+    sign = '-' if value < 0 else ''
+    whole, fraction = divmod(abs(value), TILE_FAN_OUT ** depth)
+    return f'{sign}{whole}.{fraction:0{depth}d}0'
+
+
+class Tile(NamedTuple):
+    """
+    A lat:long search cell. latitude/longitude hold the south-west corner in units of 10^-depth degrees
+    so that tiles are exact and hashable, e.g. Tile(491, -25, 1) spans 49.1..49.2 by -2.5..-2.4
+    """
+    latitude: int
+    longitude: int
+    depth: int = 0
+
+    @property
+    def bounds(self) -> Tuple[float, float, float, float]:
+        """(south, west, north, east) in degrees"""
+        scale = TILE_FAN_OUT ** self.depth
+        south, west = self.latitude / scale, self.longitude / scale
+        return south, west, (self.latitude + 1) / scale, (self.longitude + 1) / scale
+
+    @property
+    def query_coordinates(self) -> Tuple[str, str]:
+        return format_coordinate(self.latitude, self.depth), format_coordinate(self.longitude, self.depth)
+
+    @property
+    def parent(self) -> 'Tile':
+        return Tile(self.latitude // TILE_FAN_OUT, self.longitude // TILE_FAN_OUT, self.depth - 1)
+
+    def children(self) -> Iterator['Tile']:
+        for i in range(TILE_FAN_OUT):
+            for j in range(TILE_FAN_OUT):
+                yield Tile(
+                    self.latitude * TILE_FAN_OUT + i,
+                    self.longitude * TILE_FAN_OUT + j,
+                    self.depth + 1
+                )
+
+    def is_on_land(self) -> bool:
+        """False when the tile is entirely open sea or outside GB/NI"""
+        south, west, north, east = self.bounds
+        return any(
+            south < box_north and north > box_south and west < box_east and east > box_west
+            for box_south, box_west, box_north, box_east in GB_LAND_BOUNDING_BOXES
+        )
+
+    def __str__(self):
+        return '{},{}'.format(*self.query_coordinates)
+
+
+def top_level_tiles() -> Iterator[Tile]:
+    for latitude in range(SOUTHERN_MOST_LATITUDE_UK, NORTHERN_MOST_LATITUDE_UK + 1):
+        for longitude in range(WESTERN_MOST_LONGITUDE_UK, EASTERN_MOST_LONGITUDE_UK + 1):
+            yield Tile(latitude, longitude)
+
+
+class TileRecord(NamedTuple):
+    total: int
+    last_page: Optional[int]
+    timestamp: int
+
+
+class TileIndex:
+    """
+    Tile density index persisted between crawls: tile -> last seen meta.total, meta.last_page and timestamp.
+    Lets the next crawl go straight to the tiles it needs at the right depth, instead of re-probing every
+    dense parent tile, and fan out page requests from the known last_page.
+    """
+    # Split tiles whose children add up to less than this share of the cap are merged back into one tile
+    MERGE_THRESHOLD = 0.8
+
+    def __init__(self, path: Union[Path, str], max_depth: int, tiles: Optional[Dict[Tile, TileRecord]] = None):
+        self.path = Path(path)
+        self.max_depth = max_depth
+        self.tiles = tiles or {}
+
+    @classmethod
+    def load(cls, path: Union[Path, str], max_depth: int, max_age: Optional[int] = None) -> 'TileIndex':
+        """Load the index, ignoring records older than max_age seconds"""
+        path = Path(path)
+        tiles = {}
+        if path.exists():
+            with open(path, 'r', encoding='utf-8') as f:
+                raw_tiles = json.load(f)
+            min_timestamp = time.time() - max_age if max_age else 0
+            for key, (total, last_page, timestamp) in raw_tiles.items():
+                if timestamp >= min_timestamp:
+                    tiles[Tile(*map(int, key.split(',')))] = TileRecord(total, last_page, timestamp)
+        return cls(path, max_depth, tiles)
+
+    def save(self):
+        raw_tiles = {f'{tile.latitude},{tile.longitude},{tile.depth}': record for tile, record in self.tiles.items()}
+        tmp_path = self.path.with_suffix(self.path.suffix + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(raw_tiles, f, separators=(',', ':'))
+        tmp_path.replace(self.path)
+
+    def merge(self, other: 'TileIndex'):
+        """Add the records of another index, e.g. a shard's, keeping the most recent record of each tile"""
+        for tile, record in other.tiles.items():
+            if tile not in self.tiles or record.timestamp > self.tiles[tile].timestamp:
+                self.tiles[tile] = record
+
+    def record(self, tile: Tile, total: int, last_page: int):
+        self.tiles[tile] = TileRecord(total, last_page, int(time.time()))
+
+    def is_split(self, tile: Tile) -> bool:
+        record = self.tiles.get(tile)
+        return bool(record) and record.total > BOUNDING_BOX_RESULTS_CAP and tile.depth < self.max_depth
+
+    def known_last_page(self, tile: Tile) -> Optional[int]:
+        record = self.tiles.get(tile)
+        return record.last_page if record else None
+
+    def fixed_grid_pages(self, tile: Tile) -> int:
+        """
+        Pages the fixed grid adaptive tiling replaced would have requested for a top level tile: every page of the
+        tile, or if it's over the cap its first page and every page of each of its 100 sub tiles, offshore ones and
+        over the cap ones included. Tiles without a record count as their first page only.
+        """
+        record = self.tiles.get(tile)
+        if not record:
+            return 1
+        if tile.depth == 0 and record.total > BOUNDING_BOX_RESULTS_CAP:
+            return 1 + sum(self.fixed_grid_pages(child) for child in tile.children())
+        return max(record.last_page or 1, 1)
+
+    def plan(self, tiles: Iterable[Tile]) -> Iterator[Tile]:
+        """Replace every tile known to be over the cap with its sub tiles, recursively"""
+        for tile in tiles:
+            if self.is_split(tile):
+                yield from self.plan(tile.children())
+            else:
+                yield tile
+
+    def compact(self):
+        """
+        Drop records no longer reachable from the top level tiles, e.g. sub tiles of a tile that is now under
+        the cap, and merge split tiles whose sub tiles have drifted well under the cap back into a single tile.
+        """
+        compacted = {}
+        for tile in top_level_tiles():
+            self._compact(tile, compacted)
+        self.tiles = compacted
+
+    def _compact(self, tile: Tile, compacted: Dict[Tile, TileRecord]) -> Optional[int]:
+        """Copy the live records under tile into compacted, returns the tile's total when fully known"""
+        record = self.tiles.get(tile)
+        if not record:
+            return None
+        if not self.is_split(tile):
+            compacted[tile] = record
+            return record.total
+
+        child_totals = [self._compact(child, compacted) for child in tile.children() if child.is_on_land()]
+        if None in child_totals:
+            compacted[tile] = record
+            return None
+        total = sum(child_totals)
+        if total < BOUNDING_BOX_RESULTS_CAP * self.MERGE_THRESHOLD:
+            for child in tile.children():
+                self._discard_subtree(child, compacted)
+            # The merged tile's page count is unknown until it's probed again
+            compacted[tile] = TileRecord(total, None, int(time.time()))
+        else:
+            compacted[tile] = record
+        return total
+
+    def _discard_subtree(self, tile: Tile, compacted: Dict[Tile, TileRecord]):
+        if compacted.pop(tile, None) and tile.depth < self.max_depth:
+            for child in tile.children():
+                self._discard_subtree(child, compacted)
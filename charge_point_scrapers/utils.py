@@ -1,21 +1,26 @@
+import base64
 import copy
 import hashlib
-import re
+import itertools
 import os
 import json
 
-from typing import Union
-from dateutil import parser
+from typing import Iterable, Iterator, Union
+import numpy as np
 from scrapy import Request, Spider
 from openpyxl import Workbook, load_workbook
-from openpyxl.styles import NamedStyle, Font
-from openpyxl.utils.exceptions import IllegalCharacterError
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
 from openpyxl.utils import get_column_letter
 from pathlib import PosixPath, Path
 from dotenv import load_dotenv
 from geopy import distance
 
-from charge_point_scrapers.constants import ZAP_MAP_REQUEST_HEADERS, CO_CHARGER_REQUEST_HEADERS, SheetNames, EnvKeys
+from charge_point_scrapers.normalisation import ADDRESS_TABLE, CONTROL_CHARACTERS_TABLE, sanitise
+from charge_point_scrapers.constants import (
+    ZAP_MAP_REQUEST_HEADERS, CO_CHARGER_REQUEST_HEADERS, EnvKeys, EARTH_RADIUS_MILES, HAVERSINE_MAX_ERROR,
+    EXCEL_WIDTH_SAMPLE_ROWS
+)
 
 load_dotenv()
 
@@ -28,6 +33,16 @@ def copy_headers(original_headers, update_data: Union[dict, None]) -> dict:
     return headers
 
 
+def get_jsonl_feed_path(settings) -> Union[Path, None]:
+    """Path of the first FEEDS entry, if it's a json lines feed"""
+    root_dir = Path(__file__).parent.parent
+    feeds = settings.get('FEEDS')
+    feed_paths = list(feeds.keys())
+    if feed_paths and feeds[feed_paths[0]]['format'] == 'jl':
+        return root_dir / feed_paths[0]
+    return None
+
+
 def request_zap_auth_token(callback):
     auth_req_headers = copy_headers(
         ZAP_MAP_REQUEST_HEADERS,
@@ -41,120 +56,188 @@ def request_zap_auth_token(callback):
     )
 
 
-def parse_date(date_str: str):
-    parsed_date = parser.parse(date_str)
-    return parsed_date.strftime('%Y-%m-%d')
+def decode_jwt_expiry(token: str) -> Union[float, None]:
+    """exp claim of a JWT as a unix timestamp, the signature isn't checked"""
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
 
 
-def remove_control_characters(cells):
-    clean_strings = []
-    for cell in cells:
-        illegal_chars = re.compile(r'[\000-\010]|[\013-\014]|[\016-\037]')
-        if illegal_chars.findall(str(cell)):
-            cell = re.sub(illegal_chars, ' ', str(cell))
-        clean_strings.append(cell)
-    return clean_strings
+def co_charger_radius_filter_enabled() -> bool:
+    return not int(os.getenv(EnvKeys.CO_CHARGER_IGNORE_20_MILE_RADIUS.value) or 0)
 
 
-def filter_co_charger_radius(data):
-    cities = {
-        'Peterborough': (52.573552730184225, -0.25514820758860557),
-        'Oxfordshire': (51.74383552545767, -1.2459381017248494),
-        'Wimbledon': (51.42990367179369, -0.22438352969388295),
-        'Bristol': (51.455539352076414, -2.5872982645856237),
-        'Birmingham': (52.494308381894776, -1.8718849325622116),
-        'Manchester': (53.48602564820113, -2.2399557350492376),
-        'Milton Keynes': (52.040187985429135, -0.7580044689136244),
-        'Reading': (51.45420910597151, -0.9802584269217173)
-    }
-    matching_hosts = {}
-    for host in data:
-        for city, city_cords in cities.items():
-            geo_dist = distance.distance(city_cords, (float(host['latitude']), float(host['longitude'])))
-            if geo_dist.miles < 21.0:
-                if host['id'] in matching_hosts:
-                    continue
-                else:
-                    matching_hosts[host['id']] = host
+def filter_co_charger_radius(data, locations: dict, exact_boundary: bool = True) -> list:
+    """
+    Hosts within the radius of any of the locations, given as {name: (latitude, longitude, radius_miles)}
+    Distances to every location are computed at once with the haversine formula. It's off by up to ~0.5% from
+    the geodesic distance on the WGS-84 ellipsoid, so with exact_boundary hosts that close to a radius are
+    checked again with geopy's geodesic distance. Benchmarked by python -m charge_point_scrapers.benchmarks
+    """
+    hosts = list(data)
+    if not hosts or not locations:
+        return []
+
+    host_coords = np.radians(np.array([[float(host['latitude']), float(host['longitude'])] for host in hosts]))
+    location_coords = np.radians(np.array([location[:2] for location in locations.values()], dtype=float))
+    radii = np.array([location[2] for location in locations.values()], dtype=float)
+
+    # (hosts, locations) distance matrix
+    d_lat = host_coords[:, 0, None] - location_coords[None, :, 0]
+    d_long = host_coords[:, 1, None] - location_coords[None, :, 1]
+    a = np.sin(d_lat / 2) ** 2 + \
+        np.cos(host_coords[:, 0, None]) * np.cos(location_coords[None, :, 0]) * np.sin(d_long / 2) ** 2
+    miles = 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(a))
+    within_radius = miles < radii
+
+    if exact_boundary:
+        near_boundary = np.abs(miles - radii) <= radii * HAVERSINE_MAX_ERROR
+        for host_idx, location_idx in zip(*np.nonzero(near_boundary)):
+            host = hosts[host_idx]
+            geo_dist = distance.distance(
+                np.degrees(location_coords[location_idx]),
+                (float(host['latitude']), float(host['longitude']))
+            )
+            within_radius[host_idx, location_idx] = geo_dist.miles < radii[location_idx]
+
+    return [host for host, matches in zip(hosts, within_radius.any(axis=1)) if matches]
+
+
+def radius_bounding_box(latitude: float, longitude: float, radius_miles: float) -> tuple:
+    """(min_lat, min_long, max_lat, max_long) of a box containing the radius around the location"""
+    # Padded so the box also contains everything within the haversine error margin
+    radius_miles *= 1 + HAVERSINE_MAX_ERROR * 2
+    d_lat = np.degrees(radius_miles / EARTH_RADIUS_MILES)
+    d_long = d_lat / np.cos(np.radians(min(abs(latitude) + d_lat, 89.0)))
+    return latitude - d_lat, longitude - d_long, latitude + d_lat, longitude + d_long
+
+
+def read_latest_feed_records(jsonl_feed_path: Union[PosixPath, Path], key_field: str) -> Iterator[dict]:
+    """
+    Stream the feed's records line by line, keeping only the latest record per key_field.
+    Records re-scraped by delta crawls replace earlier ones with the same key_field, deleted records are dropped.
+    The feed is read twice, first to find the line of each key's latest record, so only line numbers are held
+    in memory rather than the records.
+    """
+    latest_lines = {}
+    with open(jsonl_feed_path, 'r', encoding='utf-8') as f:
+        for line_no, line in enumerate(f):
+            record = json.loads(line)
+            if record.get('deleted'):
+                latest_lines.pop(record[key_field], None)
+            else:
+                latest_lines[record[key_field]] = line_no
+    keep_lines = set(latest_lines.values())
+    del latest_lines
+
+    def records():
+        with open(jsonl_feed_path, 'r', encoding='utf-8') as feed:
+            for idx, feed_line in enumerate(feed):
+                if idx in keep_lines:
+                    yield json.loads(feed_line)
+
+    return records()
+
+
+def filter_co_charger_radius_in_chunks(records: Iterable[dict], chunk_size: int = 10000, **kwargs) -> Iterator[dict]:
+    records = iter(records)
+    while True:
+        chunk = list(itertools.islice(records, chunk_size))
+        if not chunk:
+            return
+        yield from filter_co_charger_radius(chunk, **kwargs)
+
+
+def update_column_width(column_lens: dict, column_letter: str, key: str, val: str):
+    if len(val) > column_lens.get(column_letter, 0):
+        if key in ['address', 'name']:
+            column_lens[column_letter] = len(val) * .8
+        elif key in ['charging_fee', 'parking_fee']:
+            column_lens[column_letter] = len(val) * .53
+        else:
+            column_lens[column_letter] = len(val)
+
+
+def write_sheet(sheet, header: list, rows: Iterable[list], keys: Union[list, None] = None):
+    """
+    Stream rows into a write-only sheet. Column widths have to be set before any row is written so they
+    are sized from the header and a sample of the first EXCEL_WIDTH_SAMPLE_ROWS rows.
+    """
+    rows = iter(rows)
+    sample = list(itertools.islice(rows, EXCEL_WIDTH_SAMPLE_ROWS))
+    keys = keys or [''] * len(header)
+    column_lens = {}
+    for col_num, value in enumerate(header, start=1):
+        column_lens[get_column_letter(col_num)] = len(str(value or '')) * 1.2
+    for row in sample:
+        for col_num, (key, val) in enumerate(zip(keys, row), start=1):
+            update_column_width(column_lens, get_column_letter(col_num), key, str(val or ''))
+    for column_letter, width in column_lens.items():
+        sheet.column_dimensions[column_letter].width = width
+
+    header_cells = []
+    for value in header:
+        cell = WriteOnlyCell(sheet, value=value)
+        cell.font = Font(bold=True, size=12)
+        header_cells.append(cell)
+    sheet.append(header_cells)
 
-    return matching_hosts
+    for row in itertools.chain(sample, rows):
+        sheet.append(row)
 
 
 def export_to_excel(
         excel_file_path: Union[PosixPath, Path],
-        jsonl_feed_path: Union[PosixPath, Path],
+        records: Iterable[dict],
         col_mapping: dict,
         sheet_name: str,
         spider: Spider
 ):
     """
-    Export json lines feed to excel.
+    Export records to excel.
     IF sheet name exists, delete
     Always creates a new sheet with the name
+    Records are streamed into a write-only workbook and the workbook's other sheets are copied over row by row,
+    so neither the records nor the existing workbook are loaded into memory.
+    Values are sanitised as rows are built, a write-only sheet can't be appended to again once a cell raises
+    IllegalCharacterError.
     """
+    tables = [ADDRESS_TABLE if key in ['address', 'street'] else CONTROL_CHARACTERS_TABLE for key in col_mapping]
+
+    def rows():
+        for record in records:
+            row_val = []
+            for key, table in zip(col_mapping, tables):
+                val = sanitise(record[key], table)
+                if not val:
+                    val = 'N/A'
+                row_val.append(val)
+            yield row_val
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(sheet_name)
+    write_sheet(sheet, list(col_mapping.values()), rows(), keys=list(col_mapping))
+
+    tmp_file_path = excel_file_path.with_name(f'.{excel_file_path.name}.tmp')
     if excel_file_path.exists():
-        workbook = load_workbook(filename=excel_file_path)
+        existing_workbook = load_workbook(filename=excel_file_path, read_only=True)
+        for existing_sheet in existing_workbook.worksheets:
+            if existing_sheet.title == sheet_name:
+                continue
+            existing_rows = existing_sheet.iter_rows(values_only=True)
+            header = next(existing_rows, None)
+            if header is None:
+                workbook.create_sheet(existing_sheet.title)
+                continue
+            write_sheet(workbook.create_sheet(existing_sheet.title), list(header), existing_rows)
+        workbook.save(filename=tmp_file_path)
+        existing_workbook.close()
     else:
-        workbook = Workbook()
-
-    if sheet_name in workbook.sheetnames:
-        sheet = workbook[sheet_name]
-        workbook.remove(sheet)
-
-    sheet = workbook.create_sheet(sheet_name, 0)
-
-    column_lens = {}
-
-    for col_num, value in enumerate(col_mapping.values(), start=1):
-        cell = sheet.cell(row=1, column=col_num, value=value)
-        cell.font = Font(bold=True, size=12)
-        column_letter = get_column_letter(col_num)
-        column_lens[column_letter] = len(value) * 1.2
-        sheet.column_dimensions[column_letter].width = column_lens[column_letter]
-
-    header_style = NamedStyle(name='header_style')
-    header_style.font = Font(bold=True, size=14)
-    data = []
-    try:
-        with open(jsonl_feed_path, 'r', encoding='utf-8') as f:
-            for point in f.readlines():
-                data.append(json.loads(point))
-    except FileNotFoundError as ex:
-        spider.logger.exception(ex)
-        return
-
-    ignore_radius_filter = os.getenv(EnvKeys.CO_CHARGER_IGNORE_20_MILE_RADIUS.value, 0)
-    if sheet_name == SheetNames.CO_CHARGER.value and not ignore_radius_filter:
-        data = filter_co_charger_radius(data)
-
-    for row in data:
-        row_val = []
-        for idx, key in enumerate(col_mapping, start=1):
-            val = row[key]
-            if key in ['address', 'street']:
-                val = val.replace('\r', '')
-                val = val.replace('\n', ' ')
-            if not val:
-                val = 'N/A'
-            column_letter = get_column_letter(idx)
-            if len(val) > column_lens.get(column_letter, 0):
-                if key in ['address', 'name']:
-                    column_lens[column_letter] = len(val) * .8
-                elif key in ['charging_fee', 'parking_fee']:
-                    column_lens[column_letter] = len(val) * .53
-                else:
-                    column_lens[column_letter] = len(val)
-                sheet.column_dimensions[column_letter].width = column_lens[column_letter]
-
-            row_val.append(val)
-
-        try:
-            sheet.append(row_val)
-        except IllegalCharacterError as ex:
-            sheet_row = remove_control_characters(row_val)
-            sheet.append(sheet_row)
-
-    workbook.save(filename=excel_file_path)
+        workbook.save(filename=tmp_file_path)
+    tmp_file_path.replace(excel_file_path)
 
 
 def authenticate_co_charger(callback):
@@ -180,10 +263,12 @@ def authenticate_co_charger(callback):
 
 
 def fmt_co_charger_value(raw_value):
-    if not raw_value or raw_value.strip() == 'null':
+    # The API sends some values as numbers
+    raw_value = str(raw_value).strip() if raw_value else ''
+    if raw_value == 'null':
         return ''
 
-    return raw_value.strip() or ''
+    return raw_value
 
 
 def update_co_charger_auth_token(token):
@@ -0,0 +1,24 @@
+import subprocess
+import sys
+from pathlib import Path
+
+# Run in a fresh interpreter, a reactor can only be installed once per process
+IMPORT_SPIDERS_THEN_INSTALL_REACTOR = """
+from scrapy.utils.misc import walk_modules
+from scrapy.utils.reactor import install_reactor, verify_installed_reactor
+
+from charge_point_scrapers import settings
+
+walk_modules('charge_point_scrapers.spiders')
+install_reactor(settings.TWISTED_REACTOR)
+verify_installed_reactor(settings.TWISTED_REACTOR)
+"""
+
+
+def test_spider_modules_dont_install_a_reactor():
+    """The spider loader imports the spiders before Scrapy installs TWISTED_REACTOR"""
+    result = subprocess.run(
+        [sys.executable, '-c', IMPORT_SPIDERS_THEN_INSTALL_REACTOR],
+        cwd=Path(__file__).parent.parent, capture_output=True, text=True
+    )
+    assert result.returncode == 0, result.stderr